@@ -0,0 +1,84 @@
+"""
+Cold-start benchmark of the embedded mode entry path.
+
+Run from the repository root:
+    python -m benchmarks.bench_startup --budget 1.0
+
+Every measurement starts a fresh interpreter. Exits with status 1 if the
+median cold-start time of a short capture exceeds the budget, or if the
+embedded path imports a module it should not need.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from lib.DeviceEmulator import DeviceEmulator
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules only the GUI or the vibration metrics need
+DEFERRED_MODULES = ('tkinter', 'scipy', 'sqlite3', 'lib.DesktopApp', 'lib.MultiAccTestApp')
+
+IMPORT_CHECK = '''
+import sys
+import start
+from lib.AccTestApp import AccTestApp
+print(' '.join(name for name in {modules!r} if name in sys.modules))
+'''
+
+
+def run(command, cwd) -> float:
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+    start_time = time.perf_counter()
+    subprocess.run(command, cwd=cwd, env=env, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return time.perf_counter() - start_time
+
+
+def capture_command(port, num_samples):
+    return [sys.executable, os.path.join(REPO_ROOT, 'start.py'), '--port', port, '--baudrate', '230400',
+            '--selectacc', '1', '--accscale', '0', '--acqnumsamples', str(num_samples), '--acqdecfactor', '1',
+            '--acqtimsamplerate', '8000', '--readerthread', '--loglevel', 'WARNING']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold-start benchmark of the embedded mode')
+    parser.add_argument('--budget', type=float, default=1.0,
+                        help='Allowed median cold-start time of a short capture in s (default: 1.0)')
+    parser.add_argument('--runs', type=int, default=5, help='Runs per measurement (default: 5)')
+    parser.add_argument('--samples', type=int, default=32, help='acqnumsamples of the capture (default: 32)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir, DeviceEmulator() as emulator:
+        check = subprocess.run([sys.executable, '-c', IMPORT_CHECK.format(modules=DEFERRED_MODULES)],
+                               cwd=work_dir, env=dict(os.environ, PYTHONPATH=REPO_ROOT),
+                               check=True, capture_output=True, text=True)
+        eager_imports = check.stdout.split()
+
+        interpreter_s = statistics.median(run([sys.executable, '-c', 'pass'], work_dir)
+                                          for _ in range(args.runs))
+        import_s = statistics.median(run([sys.executable, '-c', 'import start; import lib.AccTestApp'], work_dir)
+                                     for _ in range(args.runs))
+        capture_s = statistics.median(run(capture_command(emulator.port, args.samples), work_dir)
+                                      for _ in range(args.runs))
+
+    print(f'{"interpreter":<12} {interpreter_s:>8.3f} s')
+    print(f'{"imports":<12} {import_s:>8.3f} s')
+    print(f'{"capture":<12} {capture_s:>8.3f} s  (budget {args.budget:.3f} s, acqnumsamples={args.samples})')
+
+    failed = False
+    if eager_imports:
+        print(f'Imported by the embedded path: {", ".join(eager_imports)}')
+        failed = True
+    if capture_s > args.budget:
+        print(f'Cold start over budget by {capture_s - args.budget:.3f} s')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
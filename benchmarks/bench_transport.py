@@ -0,0 +1,132 @@
+"""
+Transport benchmark against the device emulator.
+
+Run from the repository root:
+    python -m benchmarks.bench_transport --baudrate 230400 --sizes 1024 8192
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+from lib.logging_config import logger, setup_logging
+from lib.AccTestApp import AccTestApp
+from lib.DeviceEmulator import DeviceEmulator
+
+
+logger = logging.getLogger(__name__)
+
+# readerthread, batchwindow
+MODES = {
+    'polling': (False, 1),
+    'reader': (True, 1),
+    'pipelined': (True, 8),
+}
+
+
+def make_params(port, baudrate, mode, num_samples, loop_times=1):
+    reader_thread, batch_window = MODES[mode]
+    return {
+        'port': port,
+        'baudrate': baudrate,
+        'selectacc': 1,
+        'accscale': 1,
+        'accodr': 0,
+        'acqnumsamples': num_samples,
+        'acqdecfactor': 1,
+        'acqtimsamplerate': 8000,
+        'acqodrrun': False,
+        'acqtimerrun': True,
+        'looptimes': loop_times,
+        'batchwindow': batch_window,
+        'readerthread': reader_thread,
+        'continuous': False,
+        'batchcommands': False,
+        'format': 'bin',
+        'calibrate': False,
+        'stream': False,
+        'catalog': '',
+    }
+
+
+def bench_commands(emulator, args, mode):
+    app = AccTestApp(make_params(emulator.port, args.baudrate, mode, 1024))
+    try:
+        start_time = time.perf_counter()
+        for _ in range(args.commands):
+            app.acc.protocol.select_accelerometer(1)
+        elapsed = time.perf_counter() - start_time
+    finally:
+        app.device.disconnect()
+    return args.commands / elapsed
+
+
+def bench_download(emulator, args, mode, num_samples):
+    app = AccTestApp(make_params(emulator.port, args.baudrate, mode, num_samples))
+    try:
+        app.init()
+        app.acquire()
+        bytes_before = emulator.bytes_sent
+        start_time = time.perf_counter()
+        acc_data = app.acc.download_data()
+        elapsed = time.perf_counter() - start_time
+        num_bytes = emulator.bytes_sent - bytes_before
+    finally:
+        app.device.disconnect()
+    return len(acc_data) / elapsed, num_bytes / elapsed
+
+
+def bench_end_to_end(emulator, args, mode, num_samples):
+    app = AccTestApp(make_params(emulator.port, args.baudrate, mode, num_samples, args.looptimes))
+    try:
+        start_time = time.perf_counter()
+        app.init()
+        app.run()
+        elapsed = time.perf_counter() - start_time
+    finally:
+        app.device.disconnect()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serial transport benchmark using the device emulator')
+    parser.add_argument('--baudrate', type=int, default=230400,
+                        help='Emulated link baud rate, 0 disables throttling (default: 230400)')
+    parser.add_argument('--latency', type=float, default=0.0005, help='Reply latency in s (default: 0.0005)')
+    parser.add_argument('--jitter', type=float, default=0.0002, help='Reply jitter in s (default: 0.0002)')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1024, 8192],
+                        help='acqnumsamples values to benchmark (default: 1024 8192)')
+    parser.add_argument('--modes', nargs='+', choices=list(MODES), default=['reader', 'pipelined'],
+                        help='Transport modes, polling pays the fixed sleeps and is slow (default: reader pipelined)')
+    parser.add_argument('--commands', type=int, default=50, help='Commands sent for commands/s (default: 50)')
+    parser.add_argument('--looptimes', type=int, default=3, help='looptimes of the end-to-end run (default: 3)')
+    args = parser.parse_args()
+
+    setup_logging(level=logging.WARNING, log_file='')
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir, \
+            DeviceEmulator(baudrate=args.baudrate or None, latency_s=args.latency, jitter_s=args.jitter) as emulator:
+        # Capture files of the end-to-end runs go to the temporary directory
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            for mode in args.modes:
+                commands_per_s = bench_commands(emulator, args, mode)
+                for num_samples in args.sizes:
+                    samples_per_s, bytes_per_s = bench_download(emulator, args, mode, num_samples)
+                    run_time = bench_end_to_end(emulator, args, mode, num_samples)
+                    results.append((mode, num_samples, commands_per_s, samples_per_s, bytes_per_s, run_time))
+        finally:
+            os.chdir(cwd)
+
+    print(f'baudrate={args.baudrate} latency={args.latency}s jitter={args.jitter}s looptimes={args.looptimes}')
+    print(f'{"mode":<10} {"samples":>8} {"commands/s":>11} {"samples/s":>11} {"bytes/s":>11} {"run [s]":>9}')
+    for mode, num_samples, commands_per_s, samples_per_s, bytes_per_s, run_time in results:
+        print(f'{mode:<10} {num_samples:>8} {commands_per_s:>11.1f} {samples_per_s:>11.0f} '
+              f'{bytes_per_s:>11.0f} {run_time:>9.3f}')
+
+
+if __name__ == '__main__':
+    main()
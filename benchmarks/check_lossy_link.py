@@ -0,0 +1,98 @@
+"""
+Regression check of the batch validation, retry and resume logic against the
+device emulator.
+
+Run from the repository root:
+    python -m benchmarks.check_lossy_link --droprate 0.03 --delayrate 0.01 --seed 1
+
+A capture is downloaded over a lossless link and then over a link which
+truncates a fraction of the sample packages and sends another fraction only
+after the host stopped waiting for them, in every transport mode, with
+download_data, with a download cancelled halfway and resumed, and streamed
+with iter_sample_batches. The emulator is seeded, so every run truncates and
+delays the same packages. Exits with status 1 if any download differs from the
+lossless capture or if no package was truncated or delayed.
+"""
+import argparse
+import logging
+import sys
+
+import numpy as np
+
+from lib.logging_config import logger, setup_logging
+from lib.AccController import DownloadCancelled
+from lib.AccTestApp import AccTestApp
+from lib.DeviceEmulator import DeviceEmulator
+from lib.SerialDevice import SerialDevice
+from benchmarks.bench_transport import MODES, make_params
+
+
+logger = logging.getLogger(__name__)
+
+
+def download(emulator, mode, num_samples, method) -> np.ndarray:
+    app = AccTestApp(make_params(emulator.port, 230400, mode, num_samples))
+    try:
+        app.init()
+        app.acquire()
+        app.acc.download_sample_info()
+        if method == 'stream':
+            return np.concatenate([batch.copy() for batch in app.acc.iter_sample_batches()])
+        if method == 'resume':
+            def cancel_halfway(batches_done, num_batches, elapsed_s, samples):
+                if batches_done >= num_batches // 2:
+                    app.acc.cancel_event.set()
+
+            app.acc.progress_callback = cancel_halfway
+            try:
+                app.acc.download_data()
+                raise Exception('Download was not cancelled')
+            except DownloadCancelled:
+                app.acc.cancel_event.clear()
+            app.acc.progress_callback = None
+        return app.acc.download_data()
+    finally:
+        app.device.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lossy link regression check using the device emulator')
+    parser.add_argument('--droprate', type=float, default=0.03,
+                        help='Fraction of truncated sample packages (default: 0.03)')
+    parser.add_argument('--delayrate', type=float, default=0.01,
+                        help='Fraction of sample packages sent late (default: 0.01)')
+    parser.add_argument('--delay', type=float, default=SerialDevice.PACKAGE_TIMEOUT_S * 1.5,
+                        help=f'Delay of the late packages in s (default: {SerialDevice.PACKAGE_TIMEOUT_S * 1.5})')
+    parser.add_argument('--seed', type=int, default=1, help='Emulator seed (default: 1)')
+    parser.add_argument('--samples', type=int, default=8192, help='acqnumsamples of the capture (default: 8192)')
+    parser.add_argument('--modes', nargs='+', choices=list(MODES), default=list(MODES),
+                        help='Transport modes (default: all)')
+    args = parser.parse_args()
+
+    setup_logging(level=logging.CRITICAL, log_file='')
+
+    with DeviceEmulator(seed=args.seed) as emulator:
+        reference = download(emulator, args.modes[0], args.samples, 'download')
+
+    failed = False
+    print(f'{"mode":<10} {"method":<9} {"truncated":>9} {"delayed":>7}  result')
+    for mode in args.modes:
+        for method in ('download', 'resume', 'stream'):
+            with DeviceEmulator(drop_rate=args.droprate, delay_rate=args.delayrate, delay_s=args.delay,
+                                seed=args.seed) as emulator:
+                try:
+                    acc_data = download(emulator, mode, args.samples, method)
+                    result = 'ok' if np.array_equal(acc_data, reference) else 'MISMATCH'
+                except Exception as e:
+                    result = f'FAILED: {e}'
+                truncated = emulator.packages_dropped
+                delayed = emulator.packages_delayed
+            if result != 'ok' or not truncated or not delayed:
+                failed = True
+            print(f'{mode:<10} {method:<9} {truncated:>9} {delayed:>7}  {result}')
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
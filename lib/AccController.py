@@ -1,22 +1,60 @@
 import logging
+import os
+import threading
 import time
 from collections import namedtuple
-import math
 import numpy as np
-from scipy.fft import fft
 
+from lib.BinaryCapture import BinaryCapture
 from lib.DeviceProtocol import DeviceProtocol
+from lib.LinkCalibrator import LinkCalibrator, LinkSettings
 from lib.logging_config import logger
+from lib.metrics import registry
 from lib.utils import measure_time
 
 
 logger = logging.getLogger(__name__)
 
 
+class DownloadCancelled(Exception):
+    pass
+
+
+class DownloadCheckpoint:
+    """
+    Samples of an interrupted download and which of its batches are already valid.
+
+    """
+    def __init__(self, num_samples: int, num_batches: int, batch_size: int, dtype):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.samples = np.empty((num_batches * batch_size, 3), dtype=dtype)
+        self.done = np.zeros(num_batches, dtype=bool)
+
+
 class AccController:
     ACC_NAMES = {
     }
 
+    # Setter of every device setting, in the order they are applied
+    SETTERS = {
+        'selectacc': DeviceProtocol.select_accelerometer,
+        'accscale': DeviceProtocol.set_accelerometer_scale,
+        'accodr': DeviceProtocol.set_accelerometer_odr,
+        'acqnumsamples': DeviceProtocol.set_num_samples_to_acquire,
+        'acqdecfactor': DeviceProtocol.set_decimation_factor,
+        'acqtimsamplerate': DeviceProtocol.set_timer_sample_rate,
+    }
+
+    # Last settings successfully applied to the device on each port, valid for the
+    # connection they were applied on
+    applied_settings = {}
+
+    # Additional attempts per sample batch before the download fails
+    MAX_BATCH_RETRIES = 3
+    # Most recent samples passed to progress_callback while streaming, the capture itself is not kept
+    STREAM_PROGRESS_SAMPLES = 8192
+
     def __init__(self,
                  serial_device,
                  selectacc: int,
@@ -24,33 +62,92 @@ class AccController:
                  accodr: int,
                  acqnumsamples: int,
                  acqdecfactor: int,
-                 acqtimsamplerate: int):
+                 acqtimsamplerate: int,
+                 batchwindow: int = 1,
+                 batchcommands: bool = False):
+
+        self.set_parameters(selectacc, accscale, accodr, acqnumsamples, acqdecfactor, acqtimsamplerate,
+                            batchwindow, batchcommands)
+
+        # Called with (batches_done, num_batches, elapsed_s, samples) after every downloaded batch,
+        # samples is a view of the part of the capture downloaded so far, or the last
+        # STREAM_PROGRESS_SAMPLES samples when streaming with iter_sample_batches
+        self.progress_callback = None
+        # Checked between batches, stops the download with DownloadCancelled
+        self.cancel_event = threading.Event()
+        # Progress of the current download, kept when it is interrupted so it can be resumed
+        self.download_checkpoint = None
 
+        self.protocol = DeviceProtocol(serial_device)
+        # A new connection, the device may have been power-cycled or replaced since
+        self.applied_settings.pop(serial_device.port, None)
+
+    def set_parameters(self,
+                       selectacc: int,
+                       accscale: int,
+                       accodr: int,
+                       acqnumsamples: int,
+                       acqdecfactor: int,
+                       acqtimsamplerate: int,
+                       batchwindow: int = 1,
+                       batchcommands: bool = False):
         self.acc_id = selectacc
         self.scale = accscale
         self.odr = accodr
         self.num_samples = acqnumsamples
         self.decimation_factor = acqdecfactor
         self.timer_sample_rate = acqtimsamplerate
-
-        self.protocol = DeviceProtocol(serial_device)
+        # Number of batch requests kept in flight while downloading, 1 = stop-and-wait
+        self.batch_window = batchwindow
+        # Send all changed settings in one write instead of one command at a time
+        self.batch_commands = batchcommands
 
      
+    def settings(self) -> dict:
+        return {
+            'selectacc': self.acc_id,
+            'accscale': self.scale,
+            'accodr': self.odr,
+            'acqnumsamples': self.num_samples,
+            'acqdecfactor': self.decimation_factor,
+            'acqtimsamplerate': self.timer_sample_rate,
+        }
+
+    def _changed_settings(self, force: bool) -> dict:
+        settings = self.settings()
+        applied = self.applied_settings.get(self.protocol.serial_device.port)
+        # Other settings may belong to the previously selected accelerometer
+        if force or applied is None or applied['selectacc'] != self.acc_id:
+            return settings
+        return {name: value for name, value in settings.items() if applied.get(name) != value}
+
     @measure_time
-    def initialize_accelerometer(self):
+    def initialize_accelerometer(self, force: bool = False):
+        """
+        Applies the settings to the device. Only the settings which changed since the
+        last initialization on the same port are sent, unless `force` is set.
+        """
         logger.info('Initializing accelerometer...')
         if self.protocol.check_connection():
+            port = self.protocol.serial_device.port
+            changed = self._changed_settings(force)
+            if not changed:
+                logger.info('Accelerometer settings unchanged, skipping initialization.')
+                return
+
             try:
-                self.protocol.select_accelerometer(self.acc_id)
-                self.protocol.set_accelerometer_scale(self.scale)
-                self.protocol.set_accelerometer_odr(self.odr)
-                self.protocol.set_num_samples_to_acquire(self.num_samples)
-                self.protocol.set_decimation_factor(self.decimation_factor)
-                self.protocol.set_timer_sample_rate(self.timer_sample_rate)
+                if self.batch_commands:
+                    self.protocol.apply_settings(changed)
+                else:
+                    for name, value in changed.items():
+                        self.SETTERS[name](self.protocol, value)
 
                 self.protocol.init_accelerometer()
+                self.applied_settings[port] = self.settings()
 
             except Exception as e:
+                # The device state is unknown, apply everything next time
+                self.applied_settings.pop(port, None)
                 logger.error(f'Error initializing accelerometer: {e}')
                 raise e
         else:
@@ -65,40 +162,184 @@ class AccController:
             logger.error(f'Error changing SPI speed: {e}')
             raise e
 
+    @measure_time
+    def calibrate_link(self, num_samples: int, force: bool = False) -> LinkSettings:
+        """
+        Negotiates the baud rate and batch size with the device, see LinkCalibrator.
+        Probing downloads the `num_samples` already acquired by the device.
+
+        """
+        logger.info('Calibrating link...')
+        try:
+            return LinkCalibrator(self.protocol, window=self.batch_window).run(num_samples, force)
+        except Exception as e:
+            logger.error(f'Error calibrating link: {e}')
+            raise e
+
     @measure_time
     def run_data_acquisition_odr(self):
         logger.info('Running data acquisition with ODR...')
+        self.download_checkpoint = None
         self.protocol.run_data_acquisition_odr()
 
     @measure_time
     def run_data_acquisition_timer(self):
         logger.info('Running data acquisition with timer...')
+        self.download_checkpoint = None
         self.protocol.run_data_acquisition_timer()
 
+    def _fetch_batches(self, sample_batch_nos: list, samples: np.ndarray = None):
+        """
+        Downloads the batches, into their slots of samples if given, and yields
+        (batch no, batch samples) in order, the samples are None for an invalid batch.
+        The download stops at the first invalid batch, the rest of a pipelined stream
+        cannot be trusted to be aligned to the package boundaries any more. The batch
+        before it is taken as invalid too, after a truncated package it was read from
+        the bytes of two packages.
+
+        """
+        batch_size = self.protocol.samples_per_batch
+        if self.batch_window > 1 and len(sample_batch_nos) > 1:
+            sample_buffers = self.protocol.get_sample_batches(sample_batch_nos, self.batch_window, out=samples)
+            previous = None
+            valid = True
+            try:
+                for sample_batch_no, sample_buffer in zip(sample_batch_nos, sample_buffers):
+                    valid = len(sample_buffer) == batch_size
+                    if previous is not None:
+                        yield previous if valid else (previous[0], None)
+                    if not valid:
+                        yield sample_batch_no, None
+                        break
+                    previous = (sample_batch_no, sample_buffer)
+            finally:
+                sample_buffers.close()
+                if not valid:
+                    self._discard_late_replies()
+            if valid:
+                yield previous
+        else:
+            for sample_batch_no in sample_batch_nos:
+                out = samples[sample_batch_no * batch_size:] if samples is not None else None
+                sample_buffer = self.protocol.get_sample_batch(sample_batch_no, out=out)
+                if len(sample_buffer) != batch_size:
+                    self._discard_late_replies()
+                    yield sample_batch_no, None
+                    return
+                yield sample_batch_no, sample_buffer
+
+    def _discard_late_replies(self):
+        # A package which missed its wait may still arrive, taken for the reply to the
+        # retry every following batch would be shifted by one request
+        serial_device = self.protocol.serial_device
+        serial_device.reset_input(serial_device.PACKAGE_TIMEOUT_S)
+
+    def _count_retry(self, retries: np.ndarray, sample_batch_no: int):
+        retries[sample_batch_no] += 1
+        registry.inc('sample_batch_retries_total', accelerometer=self.acc_id)
+        if retries[sample_batch_no] > self.MAX_BATCH_RETRIES:
+            raise Exception(f'Error downloading data, batch {sample_batch_no} failed '
+                            f'{retries[sample_batch_no]} times.')
+        logger.warning(f'Invalid sample batch {sample_batch_no}, requesting it again.')
+
+    def _num_batches(self) -> int:
+        batch_size = self.protocol.samples_per_batch
+        return (self.num_samples + batch_size - 1) // batch_size
+
     @measure_time
     def download_data(self):
+        """
+        Downloads the acquired samples. Every batch is validated, invalid batches are
+        requested again up to MAX_BATCH_RETRIES times. If the download is interrupted,
+        the next call continues from the batches not downloaded yet.
+
+        """
         logger.info('Downloading data...')
         try:
-            num_batches = self.num_samples // 32
-            if self.num_samples % 32:
-                num_batches += 1
-
-            samples_x = []
-            samples_y = []
-            samples_z = []
-
-            for current_batch in range(num_batches):
-                sample_buffer = self.protocol.get_sample_batch(current_batch)
-
-                if not sample_buffer:
-                    raise Exception('Error downloading data.')
-                for samples in sample_buffer:
-                    samples_x.append(samples[0])
-                    samples_y.append(samples[1])
-                    samples_z.append(samples[2])
+            batch_size = self.protocol.samples_per_batch
+            num_batches = self._num_batches()
+
+            checkpoint = self.download_checkpoint
+            if (checkpoint is None or checkpoint.num_samples != self.num_samples
+                    or checkpoint.batch_size != batch_size):
+                checkpoint = DownloadCheckpoint(self.num_samples, num_batches, batch_size,
+                                                self.protocol.SAMPLE_DTYPE)
+                self.download_checkpoint = checkpoint
+            elif not checkpoint.done.all():
+                logger.info(f'Resuming download at {checkpoint.done.sum()}/{num_batches} batches.')
+            samples = checkpoint.samples
+
+            retries = np.zeros(num_batches, dtype=int)
+            start_time = time.perf_counter()
+            pending = np.flatnonzero(~checkpoint.done).tolist()
+            while pending:
+                # Batches are decoded straight into their slot of the preallocated array
+                for sample_batch_no, sample_buffer in self._fetch_batches(pending, samples):
+                    if sample_buffer is None:
+                        self._count_retry(retries, sample_batch_no)
+                        continue
+
+                    checkpoint.done[sample_batch_no] = True
+                    if self.progress_callback:
+                        batches_done = int(checkpoint.done.sum())
+                        self.progress_callback(batches_done, num_batches, time.perf_counter() - start_time,
+                                               samples[:min(batches_done * batch_size, self.num_samples)])
+                    if self.cancel_event.is_set():
+                        raise DownloadCancelled('Download cancelled.')
+                pending = np.flatnonzero(~checkpoint.done).tolist()
+
+            self.download_checkpoint = None
+            registry.inc('samples_downloaded_total', self.num_samples, accelerometer=self.acc_id)
+            # The last batch is padded by the device up to the full batch size
+            return samples[:self.num_samples]
+
+        except DownloadCancelled as e:
+            logger.info(f"{e}")
+            raise e
+        except Exception as e:
+            logger.error(f"Error downloading data: {e}")
+            raise e
 
-            return samples_x, samples_y, samples_z
+    def iter_sample_batches(self):
+        """
+        Yields the acquired samples batch by batch as int16 (n, 3) arrays, in capture
+        order and as soon as they are received. Only the batches in flight are held,
+        every array is a view of its own package and stays valid after the next one.
+        Invalid batches are requested again like in download_data.
 
+        """
+        logger.info('Streaming data...')
+        try:
+            batch_size = self.protocol.samples_per_batch
+            num_batches = self._num_batches()
+            retries = np.zeros(num_batches, dtype=int)
+            next_batch_no = 0
+            recent = np.empty((0, 3), dtype=self.protocol.SAMPLE_DTYPE)
+            start_time = time.perf_counter()
+
+            while next_batch_no < num_batches:
+                for sample_batch_no, sample_buffer in self._fetch_batches(list(range(next_batch_no, num_batches))):
+                    if sample_buffer is None:
+                        self._count_retry(retries, sample_batch_no)
+                        continue
+
+                    next_batch_no = sample_batch_no + 1
+                    # The last batch is padded by the device up to the full batch size
+                    sample_buffer = sample_buffer[:self.num_samples - sample_batch_no * batch_size]
+                    if self.progress_callback:
+                        # A new array every batch, the callback may hand it to another thread
+                        recent = np.concatenate((recent, sample_buffer))[-self.STREAM_PROGRESS_SAMPLES:]
+                        self.progress_callback(next_batch_no, num_batches, time.perf_counter() - start_time,
+                                               recent)
+                    yield sample_buffer
+                    if self.cancel_event.is_set():
+                        raise DownloadCancelled('Download cancelled.')
+
+            registry.inc('samples_downloaded_total', self.num_samples, accelerometer=self.acc_id)
+
+        except DownloadCancelled as e:
+            logger.info(f"{e}")
+            raise e
         except Exception as e:
             logger.error(f"Error downloading data: {e}")
             raise e
@@ -113,9 +354,20 @@ class AccController:
             raise e
 
     @measure_time
-    def save_to_file(self, sample_info: namedtuple, acc_data: tuple, filename: str = '') -> bool:
+    def save_to_file(self, sample_info: namedtuple, acc_data: np.ndarray, filename: str = '',
+                     filename_prefix: str = '') -> str:
         """
-        Saves accelerometer data to a CSV file with metadata and sample values.
+        Saves accelerometer data (an (N, 3) x/y/z array) to a CSV file with metadata and sample values.
+        Returns the name of the written file.
+        """
+        return self.stream_to_file(sample_info, [acc_data], filename, filename_prefix)
+
+    def stream_to_file(self, sample_info: namedtuple, sample_batches, filename: str = '',
+                       filename_prefix: str = '') -> str:
+        """
+        Saves accelerometer data to a CSV file like save_to_file, written batch by batch
+        as the (n, 3) batches come in, e.g. from iter_sample_batches.
+        Returns the name of the written file.
         """
         logger.info("Saving data to file...")
         if sample_info.accelerometer_id in self.ACC_NAMES:
@@ -127,7 +379,7 @@ class AccController:
             bits_per_sample = None  # Default if not defined
 
         if not filename:
-            filename = f"{acc_name}_data_{time.strftime('%Y%m%d_%H%M%S')}_{int(time.time() * 1000) % 1000}.csv"
+            filename = f"{filename_prefix}{acc_name}_data_{time.strftime('%Y%m%d_%H%M%S')}_{int(time.time() * 1000) % 1000}.csv"
 
         try:
             with open(filename, "w") as out:
@@ -155,80 +407,74 @@ class AccController:
                 out.write("x;y;z\n")
 
                 # Write sample data
-                for x, y, z in zip(*acc_data):
-                    out.write(f"{int(x)};{int(y)};{int(z)}\n")
-
-            return True
+                for sample_batch in sample_batches:
+                    np.savetxt(out, sample_batch, fmt="%d", delimiter=";")
+
+            return filename
+        except DownloadCancelled:
+            # A partial capture would not match its header
+            self._remove_partial_file(filename)
+            raise
         except Exception as e:
             logger.error(f"Error saving data to file: {e}")
+            self._remove_partial_file(filename)
             raise e
 
+    @staticmethod
+    def _remove_partial_file(filename: str):
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
 
+    @measure_time
+    def save_to_binary_file(self, sample_info: namedtuple, acc_data: np.ndarray, filename: str = '',
+                            filename_prefix: str = '') -> str:
+        """
+        Appends accelerometer data to a binary capture file (see BinaryCapture).
+        Returns the name of the written file.
+        """
+        logger.info("Saving data to binary file...")
+        if not filename:
+            acc_name = self.ACC_NAMES.get(sample_info.accelerometer_id, sample_info.accelerometer_id)
+            filename = f"{filename_prefix}{acc_name}_data_{time.strftime('%Y%m%d_%H%M%S')}_{int(time.time() * 1000) % 1000}.bin"
 
+        try:
+            BinaryCapture.append(filename, sample_info, acc_data)
+            return filename
+        except Exception as e:
+            logger.error(f"Error saving data to binary file: {e}")
+            raise e
 
+    def stream_to_binary_file(self, sample_info: namedtuple, sample_batches, filename: str = '',
+                              filename_prefix: str = '') -> str:
+        """
+        Appends accelerometer data to a binary capture file like save_to_binary_file,
+        written batch by batch as the batches of iter_sample_batches come in.
+        Returns the name of the written file.
+        """
+        logger.info("Saving data to binary file...")
+        if not filename:
+            acc_name = self.ACC_NAMES.get(sample_info.accelerometer_id, sample_info.accelerometer_id)
+            filename = f"{filename_prefix}{acc_name}_data_{time.strftime('%Y%m%d_%H%M%S')}_{int(time.time() * 1000) % 1000}.bin"
 
-    # def calculate_rms_velocity(self, sample_info: namedtuple, acc_data: tuple):
-
-    #     # def _axis_calc_rms_velocity(samples):
-    #     #     return math.sqrt(sum(x ** 2 for x in samples) / len(samples))
-
-    #     # Funkcja okna Hanninga
-    #     def hann_window(data):
-    #         return data * np.hanning(len(data))
-
-    #     # Funkcja do obliczania RMS prędkości w pasmach częstotliwości
-    #     def calc_rms_velocity(amplitude_array, freq_low, freq_high, sampling_frequency):
-    #         # Obliczenie zakresu indeksów odpowiadających częstotliwościom
-    #         low_index = int(freq_low * len(amplitude_array) / sampling_frequency)
-    #         high_index = int(freq_high * len(amplitude_array) / sampling_frequency)
-
-    #         # Obliczenie RMS w danym zakresie częstotliwości
-    #         rms = np.sqrt(np.mean(np.square(amplitude_array)))
-    #         return rms
-
-    #     # Funkcja do obliczania RMS prędkości na podstawie danych
-    #     def _axis_calc_rms_velocity(input_data, sampling_frequency, rms_vel_calc_freq_low, rms_vel_calc_freq_high):
-    #         # Krok 1: Zastosowanie okna Hanninga
-    #         windowed_data = hann_window(input_data)
-
-    #         # Krok 2: FFT na oknie danych
-    #         N = len(windowed_data)
-    #         fft_output = fft(windowed_data)
-    #         # Amplituda (moduł FFT)
-    #         amplitude_array = np.abs(fft_output[:N//2])  # Bierzemy tylko pierwszą połowę (połowa pasma Nyquista)
-
-    #         # Krok 3: Obliczanie RMS prędkości w określonym paśmie częstotliwości
-    #         rms_velocity = calc_rms_velocity(amplitude_array, rms_vel_calc_freq_low, rms_vel_calc_freq_high, sampling_frequency)
-
-    #         # Krok 4: Skalowanie RMS (jeśli wymagane)
-    #         rms_velocity *= 1.63  # Skala może być dostosowana w zależności od kalibracji
-
-    #         return rms_velocity
-
-    #     try:
-    #         scale_factors = {0: 2.0, 1: 4.0, 2: 8.0, 3: 16.0}
-    #         max_ms2 = scale_factors.get(sample_info.accelerometer_scale, None)
-    #         if max_ms2 is None:
-    #             raise Exception("max_ms2 is None")
-
-    #         scale_factor = (1.0 / 32768.0) * max_ms2
-
-    #         # Przekształcenie próbek przyspieszenia do jednostek "g"
-    #         samples_x_scaled = [x * scale_factor for x in acc_data[0]]
-    #         samples_y_scaled = [y * scale_factor for y in acc_data[1]]
-    #         samples_z_scaled = [z * scale_factor for z in acc_data[2]]
-
-    #         rms_vel_calc_freq_low = 0.1  # Dolna granica pasma częstotliwości (Hz)
-    #         rms_vel_calc_freq_high = 1000  # Górna granica pasma częstotliwości (Hz)
-
-    #         # Obliczanie RMS dla każdej osi
-    #         rms_vx = _axis_calc_rms_velocity(samples_x_scaled, sample_info.sampling_frequency, rms_vel_calc_freq_low, rms_vel_calc_freq_high)
-    #         rms_vy = _axis_calc_rms_velocity(samples_y_scaled, sample_info.sampling_frequency, rms_vel_calc_freq_low, rms_vel_calc_freq_high)
-    #         rms_vz = _axis_calc_rms_velocity(samples_z_scaled, sample_info.sampling_frequency, rms_vel_calc_freq_low, rms_vel_calc_freq_high)
+        try:
+            BinaryCapture.append_batches(filename, sample_info, sample_batches, self.num_samples)
+            return filename
+        except DownloadCancelled:
+            raise
+        except Exception as e:
+            logger.error(f"Error saving data to binary file: {e}")
+            raise e
 
-    #         print(f"RMS velocity: {rms_vx:.5f} {rms_vy:.5f} {rms_vz:.5f}")
-    #         return rms_vx, rms_vy, rms_vz
+    def calculate_vibration_metrics(self, sample_info: namedtuple, acc_data: np.ndarray) -> 'VibrationMetrics':
+        from lib.vibration_metrics import calculate_vibration_metrics
 
-    #     except Exception as e:
-    #         logger.error(f"Error calculating RMS velocity: {e}")
-    #         raise e
+        try:
+            metrics = calculate_vibration_metrics(sample_info, acc_data)
+            logger.info(f"RMS velocity: {metrics.rms_velocity[0]:.5f} {metrics.rms_velocity[1]:.5f} "
+                        f"{metrics.rms_velocity[2]:.5f}")
+            return metrics
+        except Exception as e:
+            logger.error(f"Error calculating vibration metrics: {e}")
+            raise e
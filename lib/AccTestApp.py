@@ -1,22 +1,63 @@
 import logging
+import queue
+import threading
 import time
 import argparse
+from collections import namedtuple
 
 from lib.logging_config import logger
 from lib.SerialDevice import SerialDevice
-from lib.AccController import AccController
+from lib.AccController import AccController, DownloadCancelled
 
 
 logger = logging.getLogger(__name__)
 
+Progress = namedtuple('Progress', ['iteration',
+                                   'loop_times',
+                                   'batches_done',
+                                   'num_batches',
+                                   'bytes_per_s',
+                                   'eta_s',
+                                   'sampling_frequency',
+                                   'samples'])
+
 
 class AccTestApp:
-    def __init__(self, param_dict):
+    # Captures waiting for the save worker in continuous mode
+    SAVE_QUEUE_SIZE = 2
+
+    def __init__(self, param_dict, file_prefix: str = ''):
         logger.info('Starting Serial Test App...')
         self.device = SerialDevice(
-            port=param_dict['port'], baudrate=param_dict['baudrate'])
+            port=param_dict['port'], baudrate=param_dict['baudrate'],
+            reader_thread=param_dict['readerthread'])
         self.protocol = None
+        self.file_prefix = file_prefix
+        self.acc = None
+        self._progress_callback = None
+        self.iteration = 0
+        self.sample_info = None
+        self.link_settings = None
+
+        self.update_params(param_dict)
 
+    # Called with a Progress after every downloaded batch
+    @property
+    def progress_callback(self):
+        return self._progress_callback
+
+    @progress_callback.setter
+    def progress_callback(self, callback):
+        self._progress_callback = callback
+        # Without a listener the controller does not report progress, a stream then
+        # does not build its window of recent samples
+        self.acc.progress_callback = self._on_batch if callback else None
+
+    def update_params(self, param_dict):
+        """
+        Sets the acquisition parameters. The serial connection and the controller
+        are kept, so an open session can be reused for the next run.
+        """
         self.selectacc = param_dict['selectacc']
         self.accscale = param_dict['accscale']
         self.accodr = param_dict['accodr']
@@ -24,6 +65,19 @@ class AccTestApp:
         self.acqdecfactor = param_dict['acqdecfactor']
         self.acqtimsamplerate = param_dict['acqtimsamplerate']
         self.loop_times = param_dict['looptimes']
+        self.batchwindow = param_dict['batchwindow']
+        self.batchcommands = param_dict['batchcommands']
+        self.continuous = param_dict['continuous']
+        self.file_format = param_dict['format']
+        self.calibrate = param_dict['calibrate']
+        self.stream = param_dict['stream']
+        # All iterations of a run are appended to one binary file
+        self.binary_filename = ''
+        self.binary_captures = 0
+        self.catalog = None
+        if param_dict['catalog']:
+            from lib.CaptureCatalog import CaptureCatalog
+            self.catalog = CaptureCatalog(param_dict['catalog'])
 
         if param_dict['acqodrrun']:
             self.acqodrrun = True
@@ -32,28 +86,150 @@ class AccTestApp:
             self.acqodrrun = False
             self.acqtimerrun = True
 
-        self.acc = AccController(self.device,
-                                 selectacc=self.selectacc,
-                                 accscale=self.accscale,
-                                 accodr=self.accodr,
-                                 acqnumsamples=self.acqnumsamples,
-                                 acqdecfactor=self.acqdecfactor,
-                                 acqtimsamplerate=self.acqtimsamplerate)
+        acc_params = dict(selectacc=self.selectacc,
+                          accscale=self.accscale,
+                          accodr=self.accodr,
+                          acqnumsamples=self.acqnumsamples,
+                          acqdecfactor=self.acqdecfactor,
+                          acqtimsamplerate=self.acqtimsamplerate,
+                          batchwindow=self.batchwindow,
+                          batchcommands=self.batchcommands)
+        if self.acc is None:
+            self.acc = AccController(self.device, **acc_params)
+        else:
+            self.acc.set_parameters(**acc_params)
 
     def init(self):
         self.acc.initialize_accelerometer()
 
+    def cancel(self):
+        """
+        Stops the running download after the current batch. Can be called from any thread.
+        """
+        self.acc.cancel_event.set()
+
+    def _check_cancelled(self):
+        if self.acc.cancel_event.is_set():
+            raise DownloadCancelled('Run cancelled.')
+
+    def _on_batch(self, batches_done, num_batches, elapsed_s, samples):
+        if self.progress_callback is None:
+            return
+        bytes_per_s = batches_done * self.acc.protocol.sample_package_size / elapsed_s if elapsed_s else 0.0
+        eta_s = (num_batches - batches_done) * elapsed_s / batches_done
+        self.progress_callback(Progress(self.iteration, self.loop_times, batches_done, num_batches,
+                                        bytes_per_s, eta_s, self.sample_info.sampling_frequency, samples))
+
+    def acquire(self):
+        if self.acqodrrun:
+            self.acc.run_data_acquisition_odr()
+        if self.acqtimerrun:
+            self.acc.run_data_acquisition_timer()
+
+    def download_sample_info(self):
+        sample_info = self.sample_info = self.acc.download_sample_info()
+        if self.calibrate and self.link_settings is None:
+            # The link is calibrated once per connection, on the first acquired capture
+            self.link_settings = self.acc.calibrate_link(sample_info.num_of_acq_samples)
+        return sample_info
+
+    def download(self):
+        sample_info = self.download_sample_info()
+        acc_data = self.acc.download_data()
+        return sample_info, acc_data
+
+    def _record(self, filename, sample_info, acc_data):
+        capture = 0
+        if self.file_format == 'bin':
+            self.binary_filename = filename
+            capture = self.binary_captures
+            self.binary_captures += 1
+
+        if self.catalog is not None:
+            params = dict(self.acc.settings(), port=self.device.port, baudrate=self.device.baudrate,
+                          acqodrrun=self.acqodrrun, acqtimerrun=self.acqtimerrun)
+            self.catalog.record(filename, sample_info, acc_data, params, capture)
+        return filename
+
+    def save(self, sample_info, acc_data) -> str:
+        if self.file_format == 'bin':
+            filename = self.acc.save_to_binary_file(sample_info, acc_data, filename=self.binary_filename,
+                                                    filename_prefix=self.file_prefix)
+        else:
+            filename = self.acc.save_to_file(sample_info, acc_data, filename_prefix=self.file_prefix)
+        return self._record(filename, sample_info, acc_data)
+
+    def download_and_stream(self) -> str:
+        """
+        Downloads the capture and writes it to the file batch by batch, the whole
+        capture is never held in memory. Streamed captures are catalogued without
+        statistics.
+        """
+        sample_info = self.download_sample_info()
+        sample_batches = self.acc.iter_sample_batches()
+        if self.file_format == 'bin':
+            filename = self.acc.stream_to_binary_file(sample_info, sample_batches, filename=self.binary_filename,
+                                                      filename_prefix=self.file_prefix)
+        else:
+            filename = self.acc.stream_to_file(sample_info, sample_batches, filename_prefix=self.file_prefix)
+        return self._record(filename, sample_info, None)
+
     def run(self):
-        for _ in range(self.loop_times):
-            if self.acqodrrun:
-                self.acc.run_data_acquisition_odr()
-            if self.acqtimerrun:
-                self.acc.run_data_acquisition_timer()
+        try:
+            if self.continuous:
+                if self.stream:
+                    raise Exception('Streaming cannot be combined with the continuous mode, '
+                                    'streamed captures are saved while they are downloaded')
+                self.run_continuous()
+                return
+
+            for self.iteration in range(self.loop_times):
+                self._check_cancelled()
+                self.acquire()
+                if self.stream:
+                    self.download_and_stream()
+                    continue
+                sample_info, acc_data = self.download()
+                self.save(sample_info, acc_data)
+        finally:
+            # A cancel request applies to a single run
+            self.acc.cancel_event.clear()
+
+    def run_continuous(self):
+        """
+        Starts the next acquisition as soon as the previous capture is on the host,
+        the captures are saved by a background worker. The queue is bounded, so
+        the acquisition waits when the worker falls behind.
+
+        """
+        save_queue = queue.Queue(maxsize=self.SAVE_QUEUE_SIZE)
+        save_errors = []
+
+        def save_worker():
+            while True:
+                capture = save_queue.get()
+                if capture is None:
+                    break
+                try:
+                    self.save(*capture)
+                except Exception as e:
+                    save_errors.append(e)
 
-            sample_info = self.acc.download_sample_info()
+        worker = threading.Thread(target=save_worker, name='AccSaveWorker', daemon=True)
+        worker.start()
+        try:
+            for self.iteration in range(self.loop_times):
+                if save_errors:
+                    break
+                self._check_cancelled()
+                self.acquire()
+                save_queue.put(self.download())
+        finally:
+            save_queue.put(None)
+            worker.join()
 
-            acc_data = self.acc.download_data()
-            self.acc.save_to_file(sample_info, acc_data)
+        if save_errors:
+            raise save_errors[0]
 
     def __del__(self):
         logger.info('MainApp finished.')
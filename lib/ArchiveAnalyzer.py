@@ -0,0 +1,190 @@
+import argparse
+import glob
+import logging
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from lib.logging_config import logger, setup_logging
+from lib.BinaryCapture import BinaryCapture
+from lib.CsvCapture import CsvCapture
+from lib.vibration_metrics import BAND_EDGES_HZ, calculate_capture_features
+
+
+logger = logging.getLogger(__name__)
+
+AXES = ('x', 'y', 'z')
+FEATURES = ('mean', 'rms', 'peak', 'crest_factor', 'kurtosis')
+
+
+def _analyse_file(task: tuple) -> tuple:
+    """
+    Worker of the process pool: returns (path, rows, error) for one capture file,
+    a row per capture in it. Only the features travel back, not the samples.
+
+    """
+    path, band_edges_hz = task
+    try:
+        records = BinaryCapture.read(path) if path.endswith('.bin') else [CsvCapture.read(path, sidecar=False)]
+        rows = []
+        for capture, record in enumerate(records):
+            features = calculate_capture_features(record.sample_info, record.samples, band_edges_hz)
+            rows.append((capture, record.sample_info, features))
+        return path, rows, None
+    except Exception as e:
+        return path, [], str(e)
+
+
+class ArchiveAnalyzer:
+    """
+    Calculates the capture features (see calculate_capture_features) of every CSV and
+    binary capture under a directory on a process pool and keeps them in one columnar
+    table, an .npz file with an array per column and a row per capture. Files which
+    are already in the table with the same size and modification time are skipped,
+    files which failed are kept in the table too and skipped until they change.
+
+    """
+    # Files handed to a worker at once
+    CHUNK_SIZE = 8
+    # The table is written after this many new rows, an interrupted run keeps them
+    CHECKPOINT_ROWS = 5000
+
+    def __init__(self, table_filename: str, band_edges_hz: tuple = BAND_EDGES_HZ, processes: int = None):
+        self.table_filename = table_filename
+        self.band_edges_hz = tuple(float(edge) for edge in band_edges_hz)
+        self.processes = processes or os.cpu_count()
+        self.columns = self._column_names()
+
+    def _column_names(self) -> list:
+        columns = ['path', 'file_mtime', 'file_size', 'capture', 'accelerometer_id', 'accelerometer_scale',
+                   'sampling_frequency', 'num_of_acq_samples', 'acquisition_time']
+        columns += [f'{feature}_{axis}' for feature in FEATURES for axis in AXES]
+        columns += [f'band_{low:g}_{high:g}_{axis}'
+                    for low, high in zip(self.band_edges_hz, self.band_edges_hz[1:]) for axis in AXES]
+        return columns
+
+    def _load(self) -> tuple:
+        if not os.path.exists(self.table_filename):
+            return {}, {}
+        with np.load(self.table_filename) as table:
+            if tuple(table['band_edges_hz']) != self.band_edges_hz:
+                logger.warning(f'{self.table_filename} has other band edges, analysing all files again')
+                return {}, {}
+            failed = {}
+            if 'failed_path' in table:
+                failed = {path: (mtime, size) for path, mtime, size in zip(
+                    table['failed_path'].tolist(), table['failed_mtime'].tolist(), table['failed_size'].tolist())}
+            return {column: table[column] for column in self.columns}, failed
+
+    def load_table(self) -> dict:
+        """
+        Returns the table as a dict of column arrays, empty if there is no table or it
+        was calculated with other bands.
+
+        """
+        return self._load()[0]
+
+    def load_failed(self) -> dict:
+        """
+        Returns {path: (modification time, size)} of the files which could not be analysed.
+
+        """
+        return self._load()[1]
+
+    def _write_table(self, columns: dict, failed: dict):
+        arrays = {column: np.asarray(values) for column, values in columns.items()}
+        arrays['path'] = arrays['path'].astype(str)
+        arrays['failed_path'] = np.array(list(failed), dtype=str)
+        arrays['failed_mtime'] = np.array([mtime for mtime, _ in failed.values()], dtype=np.float64)
+        arrays['failed_size'] = np.array([size for _, size in failed.values()], dtype=np.int64)
+        # Replaced at once, a reader never sees a partly written table
+        temporary = self.table_filename + '.tmp'
+        with open(temporary, 'wb') as out:
+            np.savez(out, band_edges_hz=np.array(self.band_edges_hz), **arrays)
+        os.replace(temporary, self.table_filename)
+
+    def _row(self, path: str, file_stat: os.stat_result, capture: int, sample_info, features) -> list:
+        accelerometer_id = sample_info.accelerometer_id
+        row = [path, file_stat.st_mtime, file_stat.st_size, capture,
+               accelerometer_id if isinstance(accelerometer_id, int) else -1,
+               sample_info.accelerometer_scale, sample_info.sampling_frequency,
+               sample_info.num_of_acq_samples, sample_info.acquisition_time]
+        for feature in FEATURES:
+            row += list(getattr(features, feature))
+        row += list(features.band_energy.ravel())
+        return row
+
+    def run(self, directory: str) -> int:
+        """
+        Analyses the new and changed capture files under `directory` and returns the
+        number of captures added to the table.
+
+        """
+        table, failed = self._load()
+        analysed = dict(failed)
+        if table:
+            analysed.update((path, (mtime, size)) for path, mtime, size
+                            in zip(table['path'].tolist(), table['file_mtime'].tolist(), table['file_size'].tolist()))
+
+        files = {}
+        for pattern in ('*.csv', '*.bin'):
+            for path in glob.glob(os.path.join(directory, '**', pattern), recursive=True):
+                path = os.path.abspath(path)
+                file_stat = os.stat(path)
+                if analysed.get(path) != (file_stat.st_mtime, file_stat.st_size):
+                    files[path] = file_stat
+
+        # Rows of changed files are calculated again, changed files which failed are tried again
+        columns = {column: [] for column in self.columns}
+        if table:
+            keep = np.array([path not in files for path in table['path'].tolist()], dtype=bool)
+            for column in self.columns:
+                columns[column] = table[column][keep].tolist()
+        failed = {path: stat for path, stat in failed.items() if path not in files}
+        logger.info(f'Analysing {len(files)} files under {directory} on {self.processes} processes, '
+                    f'{len(analysed)} already analysed')
+
+        added = 0
+        failed_now = 0
+        start_time = time.perf_counter()
+        tasks = ((path, self.band_edges_hz) for path in sorted(files))
+        with multiprocessing.Pool(self.processes) as pool:
+            for path, rows, error in pool.imap_unordered(_analyse_file, tasks, chunksize=self.CHUNK_SIZE):
+                if error is not None:
+                    failed_now += 1
+                    failed[path] = (files[path].st_mtime, files[path].st_size)
+                    logger.warning(f'Skipping {path}: {error}')
+                    continue
+                for capture, sample_info, features in rows:
+                    for column, value in zip(self.columns, self._row(path, files[path], capture, sample_info,
+                                                                      features)):
+                        columns[column].append(value)
+                added += len(rows)
+                if added and added % self.CHECKPOINT_ROWS < len(rows):
+                    self._write_table(columns, failed)
+
+        self._write_table(columns, failed)
+        elapsed_s = time.perf_counter() - start_time
+        logger.info(f'Added {added} captures from {len(files) - failed_now} files in {elapsed_s:.1f}s, '
+                    f'{failed_now} files failed, {len(columns["path"])} captures in {self.table_filename}')
+        return added
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch feature extraction over a capture archive')
+    parser.add_argument('directory', help='Directory searched for *.csv and *.bin captures')
+    parser.add_argument('--table', type=str, default='capture_features.npz',
+                        help='Columnar summary table (default: capture_features.npz)')
+    parser.add_argument('--processes', type=int, default=None, help='Worker processes (default: CPU count)')
+    parser.add_argument('--bands', type=float, nargs='+', default=list(BAND_EDGES_HZ),
+                        help='Band edges in Hz, inf for the Nyquist frequency (default: 0 10 100 1000 inf)')
+    args = parser.parse_args()
+    setup_logging(level=logging.INFO, log_file='')
+
+    ArchiveAnalyzer(args.table, args.bands, args.processes).run(args.directory)
+
+
+if __name__ == '__main__':
+    main()
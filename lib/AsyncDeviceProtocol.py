@@ -0,0 +1,103 @@
+import logging
+from collections import namedtuple
+
+import numpy as np
+
+from lib.logging_config import logger
+from lib.AsyncSerialDevice import AsyncSerialDevice
+from lib.DeviceProtocol import DeviceCommands, DeviceProtocol
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDeviceProtocol(DeviceCommands):
+    """
+    asyncio counterpart of DeviceProtocol. The setting, initialization and
+    acquisition commands are the ones of DeviceCommands, shared with
+    DeviceProtocol, here they return awaitables:
+
+        await protocol.select_accelerometer(1)
+        await protocol.init_accelerometer()
+        await protocol.run_data_acquisition_timer()
+
+    The wire format helpers are the ones of DeviceProtocol as well.
+
+    """
+    SAMPLES_PER_BATCH = DeviceProtocol.SAMPLES_PER_BATCH
+    SAMPLE_DTYPE = DeviceProtocol.SAMPLE_DTYPE
+
+    def __init__(self, serial_device: AsyncSerialDevice):
+        self.serial_device = serial_device
+        self.samples_per_batch = self.SAMPLES_PER_BATCH
+
+    @property
+    def sample_package_size(self) -> int:
+        return DeviceProtocol.package_size(self.samples_per_batch)
+
+    async def connect(self):
+        await self.serial_device.connect()
+
+    async def disconnect(self):
+        await self.serial_device.disconnect()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.disconnect()
+
+    async def _send_command(self, command: str, timeout: float = 0, batch_download: bool = False,
+                            response_timeout: float = None):
+        # No fixed sleeps, the reply is awaited as soon as it arrives, `timeout` is
+        # only accepted for the signature of DeviceProtocol._send_command
+        await self.serial_device.send(command)
+        if batch_download:
+            return await self.serial_device.receive_package(self.sample_package_size)
+        return await self.serial_device.receive(response_timeout)
+
+    async def _send_setting(self, command: str, **kwargs) -> str:
+        response = await self._send_command(command, **kwargs)
+        if not response.startswith(':ok'):
+            raise Exception(f'Command {command.strip()} failed: {response}')
+        return response
+
+    async def set_batch_size(self, samples_per_batch: int) -> str:
+        """
+        Sets the number of samples the device sends per batch. The following
+        batches are requested and decoded with the new size.
+
+        """
+        response = await self._send_setting(f'acqbatchsize {samples_per_batch}\n')
+        self.samples_per_batch = samples_per_batch
+        return response
+
+    async def get_firmware_version(self) -> str:
+        '''
+        Returns the firmware version of the device.
+
+        '''
+        response = await self._send_setting('getfwver\n')
+        return DeviceProtocol._parse_firmware_version(response)
+
+    async def get_sample_batch(self, sample_batch_no, out: np.ndarray = None) -> np.ndarray:
+        """
+        Returns a batch of samples from the device as an int16 (samples_per_batch, 3) array.
+        If `out` is given the samples are written into it instead.
+
+        """
+        response = await self._send_command(DeviceProtocol._sample_batch_command(sample_batch_no),
+                                            batch_download=True)
+        samples = DeviceProtocol._decode_sample_package(response, self.sample_package_size)
+        if out is None or not samples.size:
+            return samples
+        out[:len(samples)] = samples
+        return out[:len(samples)]
+
+    async def get_sample_info(self) -> namedtuple:
+        '''
+        Returns the sample info of the device.
+
+        '''
+        response = await self._send_command(DeviceProtocol._sample_info_command())
+        return DeviceProtocol._parse_sample_info(response)
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+
+import serial
+import serial_asyncio
+
+from lib.logging_config import logger, trace_wire
+from lib.metrics import registry
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSerialDevice:
+    """
+    asyncio counterpart of SerialDevice. Reads are awaited on the event loop,
+    so one loop can drive many ports without a thread per port.
+
+    """
+    RECEIVE_TIMEOUT_S = 10
+    PACKAGE_TIMEOUT_S = 1
+    # Quiet time that ends discarding the input after a failed read
+    RESET_SETTLE_S = 0.01
+    PACKAGE_HEADER = b':ok\n'
+
+    def __init__(self, port:str, baudrate:int):
+        self.port = port
+        self.baudrate = baudrate
+        self.reader = None
+        self.writer = None
+
+    @property
+    def is_connected(self) -> bool:
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self):
+        try:
+            self.reader, self.writer = await serial_asyncio.open_serial_connection(
+                url=self.port, baudrate=self.baudrate)
+            logger.debug(f'Connected to {self.port}')
+
+        except serial.SerialException as e:
+            logger.error(f'Error connecting to {self.port}: {e}')
+
+    async def disconnect(self):
+        if self.is_connected:
+            self.writer.close()
+            await self.writer.wait_closed()
+            logger.debug(f'Disconnected from {self.port}')
+
+    async def send(self, message:str, timeout=0):
+        if not self.is_connected:
+            logger.error('Attempt to send while serial port not connected.')
+            raise Exception('Serial port not connected.')
+        data = message.encode()
+        self.writer.write(data)
+        await self.writer.drain()
+        registry.inc('serial_bytes_sent_total', len(data), port=self.port)
+        trace_wire(self.port, 'tx', data)
+        logger.debug('Sent: %s', message.strip())
+        if timeout:
+            await asyncio.sleep(timeout)
+
+    async def receive(self, timeout=None) -> str:
+        if not self.is_connected:
+            logger.error('Attempt to send while serial port not connected.')
+            raise Exception('Serial port not connected.')
+        try:
+            # A line not completed in time stays buffered and is returned by the next call
+            line = await asyncio.wait_for(self.reader.readuntil(b'\n'),
+                                          self.RECEIVE_TIMEOUT_S if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            line = b''
+        registry.inc('serial_bytes_received_total', len(line), port=self.port)
+        trace_wire(self.port, 'rx', line)
+        response = line.decode().strip()
+        logger.debug('Received: %s\n', response)
+        return response
+
+    async def receive_package(self, package_size:int) -> bytes:
+        if not self.is_connected:
+            logger.error('Attempt to send while serial port not connected.')
+            raise Exception('Serial port not connected.')
+        try:
+            response = await asyncio.wait_for(self._read_package(package_size), self.PACKAGE_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            logger.error(f'Timeout waiting for package from {self.port}')
+            # The rest of a package read partly would be taken for the next reply
+            await self.reset_input()
+            return b''
+        registry.inc('serial_bytes_received_total', len(response), port=self.port)
+        trace_wire(self.port, 'rx', response)
+
+        if response.startswith(b':er'):
+            logger.error('Received: %s', response.strip())
+        else:
+            logger.debug('Received: %s + data(not writed here)\n', response[:len(b':ok')])
+        return response
+
+    async def reset_input(self):
+        """
+        Discards everything received but not read yet, until the port is quiet.
+
+        """
+        while True:
+            try:
+                data = await asyncio.wait_for(self.reader.read(65536), self.RESET_SETTLE_S)
+            except asyncio.TimeoutError:
+                break
+            if not data:
+                break
+            logger.debug('Discarded %d bytes from %s', len(data), self.port)
+
+    async def _read_package(self, package_size) -> bytes:
+        # Packages are fixed-size frames starting with a ':ok\n' header, the sample
+        # data may hold any byte, newlines included. Only an error reply is a text
+        # line, it is recognized by its first bytes.
+        header = await self.reader.readexactly(len(self.PACKAGE_HEADER))
+        if header.startswith(b':er'):
+            return header + await self.reader.readuntil(b'\n')
+        if header != self.PACKAGE_HEADER:
+            # Out of frame, the caller rejects the package
+            await self.reset_input()
+            return header
+        return header + await self.reader.readexactly(package_size - len(header))
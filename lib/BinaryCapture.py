@@ -0,0 +1,110 @@
+import os
+import struct
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from lib.DeviceProtocol import SampleInfo
+
+
+CaptureRecord = namedtuple('CaptureRecord', ['sample_info', 'bits_per_sample', 'timestamp', 'samples'])
+
+
+class BinaryCapture:
+    """
+    Binary capture file: a sequence of records, each one a 64-byte header with the
+    sample info followed by the int16 (N, 3) x/y/z block padded to 64 bytes.
+    New captures are appended to the end of the file, so one file can hold all
+    iterations of a run. Sample blocks are returned as read-only np.memmap views.
+
+    """
+    MAGIC = b'ACCBIN01'
+    ALIGNMENT = 64
+    SAMPLE_DTYPE = np.dtype('<i2')
+    # magic, accelerometer id, scale, sampling frequency, bits per sample,
+    # acquisition time [ms], capture timestamp [s], number of samples
+    HEADER = struct.Struct('<8siidiqdQ')
+    HEADER_SIZE = 64
+
+    @classmethod
+    def _padding(cls, size: int) -> int:
+        return -size % cls.ALIGNMENT
+
+    @classmethod
+    def append(cls, filename: str, sample_info: SampleInfo, acc_data: np.ndarray):
+        cls.append_batches(filename, sample_info, [acc_data], len(acc_data))
+
+    @classmethod
+    def append_batches(cls, filename: str, sample_info: SampleInfo, sample_batches, num_samples: int):
+        """
+        Appends one capture written batch by batch as the (n, 3) batches come in,
+        e.g. from AccController.iter_sample_batches. The header announces
+        `num_samples`, if the batches do not add up to it the file is truncated back
+        to its previous size.
+
+        """
+        header = cls.HEADER.pack(cls.MAGIC,
+                                 sample_info.accelerometer_id,
+                                 sample_info.accelerometer_scale,
+                                 sample_info.sampling_frequency,
+                                 cls.SAMPLE_DTYPE.itemsize * 8,
+                                 sample_info.acquisition_time,
+                                 time.time(),
+                                 num_samples)
+
+        with open(filename, 'ab') as out:
+            start_offset = out.tell()
+            try:
+                out.write(header.ljust(cls.HEADER_SIZE, b'\0'))
+                written = 0
+                for sample_batch in sample_batches:
+                    sample_batch = np.ascontiguousarray(sample_batch, dtype=cls.SAMPLE_DTYPE)
+                    out.write(sample_batch.tobytes())
+                    written += len(sample_batch)
+                if written != num_samples:
+                    raise Exception(f'Capture holds {written} samples, the header announces {num_samples}')
+                out.write(b'\0' * cls._padding(num_samples * 3 * cls.SAMPLE_DTYPE.itemsize))
+            except BaseException:
+                # A partial record would make the rest of the file unreadable
+                out.truncate(start_offset)
+                raise
+
+    @classmethod
+    def read(cls, filename: str) -> list:
+        """
+        Returns a CaptureRecord for every capture in the file. Samples are
+        memory-mapped, nothing but the headers is read here.
+
+        """
+        records = []
+        file_size = os.path.getsize(filename)
+        with open(filename, 'rb') as f:
+            offset = 0
+            while offset < file_size:
+                f.seek(offset)
+                header = f.read(cls.HEADER_SIZE)
+                if len(header) < cls.HEADER_SIZE:
+                    raise Exception(f'Truncated capture header in {filename} at offset {offset}')
+                (magic, acc_id, scale, frequency, bits_per_sample,
+                 acquisition_time, timestamp, num_samples) = cls.HEADER.unpack_from(header)
+                if magic != cls.MAGIC:
+                    raise Exception(f'Invalid capture header in {filename} at offset {offset}')
+
+                data_offset = offset + cls.HEADER_SIZE
+                data_size = num_samples * 3 * cls.SAMPLE_DTYPE.itemsize
+                if num_samples:
+                    samples = np.memmap(filename, dtype=cls.SAMPLE_DTYPE, mode='r',
+                                        offset=data_offset, shape=(num_samples, 3))
+                else:
+                    samples = np.empty((0, 3), dtype=cls.SAMPLE_DTYPE)
+
+                sample_info = SampleInfo(accelerometer_id=acc_id,
+                                         accelerometer_scale=scale,
+                                         sampling_frequency=frequency,
+                                         num_of_acq_samples=num_samples,
+                                         acquisition_time=acquisition_time)
+                records.append(CaptureRecord(sample_info, bits_per_sample, timestamp, samples))
+                offset = data_offset + data_size + cls._padding(data_size)
+
+        return records
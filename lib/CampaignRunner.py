@@ -0,0 +1,184 @@
+import itertools
+import json
+import logging
+import os
+import time
+from collections import namedtuple
+
+from lib.logging_config import logger
+from lib.AccTestApp import AccTestApp
+from lib.BinaryCapture import BinaryCapture
+
+
+logger = logging.getLogger(__name__)
+
+CampaignRecord = namedtuple('CampaignRecord', ['point',
+                                               'repeat',
+                                               'params',
+                                               'capture',
+                                               'sample_info',
+                                               'reconfigure_time_s',
+                                               'acquisition_time_s',
+                                               'download_time_s',
+                                               'save_time_s'])
+
+
+class CampaignRunner:
+    """
+    Runs a parameter sweep on one device in a single session. The plan (JSON or
+    TOML) holds the parameters shared by all points under 'base', the swept ones
+    as lists under 'sweep', the captures per point under 'repeat' and the dataset
+    file under 'output'. Example:
+
+        {"base": {"acqnumsamples": 8192},
+         "sweep": {"accscale": [0, 1, 2, 3], "acqtimsamplerate": [4000, 8000]},
+         "repeat": 1, "output": "campaign.bin"}
+
+    The points are ordered so that consecutive points differ in one parameter and
+    settings which are expensive to change vary slowest. All captures are appended
+    to the binary dataset, the parameters and timings of every capture are written
+    to a CSV table next to it. A campaign into an existing dataset continues its
+    table, which has to have the same columns.
+
+    """
+    # Outermost first: switching the accelerometer resends all settings and the SPI
+    # speed needs its own initialization, run parameters cost nothing to change
+    DIMENSION_ORDER = ('selectacc', 'ovraccspispeed', 'accscale', 'accodr', 'acqdecfactor', 'acqtimsamplerate',
+                       'acqnumsamples', 'acqodrrun', 'acqtimerrun')
+
+    def __init__(self, param_dict: dict, plan: dict):
+        self.sweep = {name: list(values) for name, values in plan.get('sweep', {}).items()}
+        unknown = [name for name in {**plan.get('base', {}), **self.sweep} if name not in self.DIMENSION_ORDER]
+        if unknown:
+            raise Exception(f'Unknown campaign parameters: {", ".join(unknown)}')
+        empty = [name for name, values in self.sweep.items() if not values]
+        if empty:
+            raise Exception(f'No values to sweep for: {", ".join(empty)}')
+
+        self.base = {**param_dict, **plan.get('base', {})}
+        self.repeat = plan.get('repeat', 1)
+        self.output = plan.get('output') or f"campaign_{time.strftime('%Y%m%d_%H%M%S')}.bin"
+        self.summary_filename = os.path.splitext(self.output)[0] + '.csv'
+        self.app = None
+        self.acc_id = None
+        self.spi_speed = None
+        self.records = []
+
+    @classmethod
+    def load_plan(cls, filename: str) -> dict:
+        if filename.endswith('.toml'):
+            import tomllib
+            with open(filename, 'rb') as f:
+                return tomllib.load(f)
+        with open(filename) as f:
+            return json.load(f)
+
+    def points(self) -> list:
+        """
+        Returns the parameters of every point in run order. Every dimension runs
+        back and forth inside the ones around it, so neighbouring points differ in
+        exactly one parameter.
+
+        """
+        names = sorted(self.sweep, key=self.DIMENSION_ORDER.index)
+        points = [{}]
+        for name in names:
+            points = [{**point, name: value}
+                      for index, point in enumerate(points)
+                      for value in (self.sweep[name] if index % 2 == 0 else reversed(self.sweep[name]))]
+        return points
+
+    def _configure(self, params: dict):
+        if self.app is None:
+            self.app = AccTestApp(params)
+        else:
+            self.app.update_params(params)
+        self.app.init()
+
+        # The SPI override belongs to the selected accelerometer
+        acc_id = params.get('selectacc')
+        if acc_id != self.acc_id:
+            self.acc_id = acc_id
+            self.spi_speed = None
+
+        spi_speed = params.get('ovraccspispeed')
+        if spi_speed is not None and spi_speed != self.spi_speed:
+            self.app.acc.change_spi_speed(spi_speed)
+            self.spi_speed = spi_speed
+
+    def _write_summary_header(self, append: bool):
+        header = ';'.join(['point', 'repeat', 'capture', *self.sweep, 'sampling_frequency[Hz]',
+                           'num_of_samples', 'reconfigure_time[s]', 'acquisition_time[s]',
+                           'download_time[s]', 'save_time[s]']) + '\n'
+        if append and os.path.exists(self.summary_filename):
+            # The rows of the captures already in the dataset are kept
+            with open(self.summary_filename) as f:
+                if f.readline() != header:
+                    raise Exception(f'{self.summary_filename} has other columns than this campaign, '
+                                    f'use another output')
+            return
+        with open(self.summary_filename, 'w') as out:
+            out.write(header)
+
+    def _write_summary_row(self, record: CampaignRecord):
+        with open(self.summary_filename, 'a') as out:
+            out.write(';'.join(str(value) for value in (
+                record.point, record.repeat, record.capture, *(record.params[name] for name in self.sweep),
+                f'{record.sample_info.sampling_frequency:.2f}', record.sample_info.num_of_acq_samples,
+                f'{record.reconfigure_time_s:.4f}', f'{record.acquisition_time_s:.4f}',
+                f'{record.download_time_s:.4f}', f'{record.save_time_s:.4f}')) + '\n')
+
+    def run(self) -> list:
+        points = self.points()
+        logger.info(f'Running campaign of {len(points)} points x {self.repeat} captures into {self.output}')
+        append = os.path.exists(self.output)
+        capture = itertools.count(len(BinaryCapture.read(self.output)) if append else 0)
+        self._write_summary_header(append)
+        campaign_start = time.perf_counter()
+
+        try:
+            for point, swept in enumerate(points):
+                params = {**self.base, **swept}
+                start_time = time.perf_counter()
+                self._configure(params)
+                reconfigure_time_s = time.perf_counter() - start_time
+
+                for repeat in range(self.repeat):
+                    start_time = time.perf_counter()
+                    self.app.acquire()
+                    acquired_time = time.perf_counter()
+                    if self.app.stream:
+                        # Saved while downloading, the download time includes saving
+                        sample_info = self.app.download_sample_info()
+                        self.app.acc.stream_to_binary_file(sample_info, self.app.acc.iter_sample_batches(),
+                                                           filename=self.output)
+                        acc_data = None
+                        downloaded_time = time.perf_counter()
+                    else:
+                        sample_info, acc_data = self.app.download()
+                        downloaded_time = time.perf_counter()
+                        self.app.acc.save_to_binary_file(sample_info, acc_data, filename=self.output)
+                    capture_no = next(capture)
+                    if self.app.catalog is not None:
+                        self.app.catalog.record(self.output, sample_info, acc_data, swept, capture_no)
+                    saved_time = time.perf_counter()
+
+                    record = CampaignRecord(point=point,
+                                            repeat=repeat,
+                                            params=params,
+                                            capture=capture_no,
+                                            sample_info=sample_info,
+                                            reconfigure_time_s=reconfigure_time_s if repeat == 0 else 0.0,
+                                            acquisition_time_s=acquired_time - start_time,
+                                            download_time_s=downloaded_time - acquired_time,
+                                            save_time_s=saved_time - downloaded_time)
+                    self.records.append(record)
+                    self._write_summary_row(record)
+                logger.info(f'Campaign point {point + 1}/{len(points)} done: {swept}')
+        finally:
+            if self.app is not None:
+                self.app.device.disconnect()
+
+        logger.info(f'Campaign finished in {time.perf_counter() - campaign_start:.1f}s, '
+                    f'{len(self.records)} captures in {self.output}, summary in {self.summary_filename}')
+        return self.records
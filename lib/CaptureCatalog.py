@@ -0,0 +1,229 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import namedtuple
+from contextlib import closing
+from datetime import datetime
+
+import numpy as np
+
+from lib.logging_config import logger, setup_logging
+from lib.BinaryCapture import BinaryCapture
+from lib.CsvCapture import CsvCapture
+from lib.DeviceProtocol import SampleInfo
+
+
+logger = logging.getLogger(__name__)
+
+CatalogEntry = namedtuple('CatalogEntry', ['path', 'capture', 'format', 'created', 'sample_info', 'params',
+                                           'size_bytes', 'mean', 'rms', 'peak'])
+
+
+class CaptureCatalog:
+    """
+    SQLite index of the capture files. Every capture is recorded with its path,
+    sample info, the parameters it was acquired with, its size and per-axis
+    statistics (mean, AC RMS and peak in counts), so captures can be found
+    without opening the files. A binary file holds one row per capture in it.
+
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS captures (
+            path TEXT NOT NULL,
+            capture INTEGER NOT NULL,
+            format TEXT NOT NULL,
+            created REAL NOT NULL,
+            accelerometer_id,
+            accelerometer_scale INTEGER,
+            sampling_frequency REAL,
+            num_of_acq_samples INTEGER,
+            acquisition_time INTEGER,
+            params TEXT,
+            size_bytes INTEGER,
+            mean_x REAL, mean_y REAL, mean_z REAL,
+            rms_x REAL, rms_y REAL, rms_z REAL,
+            peak_x REAL, peak_y REAL, peak_z REAL,
+            PRIMARY KEY (path, capture)
+        );
+        CREATE INDEX IF NOT EXISTS captures_settings
+            ON captures (accelerometer_id, accelerometer_scale, sampling_frequency, created);
+        CREATE INDEX IF NOT EXISTS captures_created ON captures (created);
+    '''
+    COLUMNS = ('path', 'capture', 'format', 'created', 'accelerometer_id', 'accelerometer_scale',
+               'sampling_frequency', 'num_of_acq_samples', 'acquisition_time', 'params', 'size_bytes',
+               'mean_x', 'mean_y', 'mean_z', 'rms_x', 'rms_y', 'rms_z', 'peak_x', 'peak_y', 'peak_z')
+    # Sampling frequencies are reported with two decimals
+    FREQUENCY_TOLERANCE_HZ = 0.5
+    # Seconds to wait for another writer of the same catalog
+    LOCK_TIMEOUT_S = 30
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        with closing(self._connect()) as db:
+            db.executescript(self.SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        # A connection per operation, captures are recorded from the save worker threads too
+        return sqlite3.connect(self.filename, timeout=self.LOCK_TIMEOUT_S)
+
+    @classmethod
+    def _row(cls, path: str, capture: int, file_format: str, created: float, sample_info: SampleInfo,
+             params: dict, size_bytes: int, acc_data: np.ndarray = None) -> tuple:
+        if acc_data is not None and len(acc_data):
+            acc_data = np.asarray(acc_data, dtype=np.float64)
+            stats = (*acc_data.mean(axis=0), *acc_data.std(axis=0), *np.abs(acc_data).max(axis=0))
+        else:
+            stats = (None,) * 9
+        return (os.path.abspath(path), capture, file_format, created, *sample_info,
+                json.dumps(params) if params is not None else None, size_bytes,
+                *(float(value) if value is not None else None for value in stats))
+
+    def _insert(self, rows: list):
+        placeholders = ', '.join('?' * len(self.COLUMNS))
+        with closing(self._connect()) as db, db:
+            db.executemany(f'INSERT OR REPLACE INTO captures ({", ".join(self.COLUMNS)}) '
+                           f'VALUES ({placeholders})', rows)
+
+    def record(self, path: str, sample_info: SampleInfo, acc_data: np.ndarray, params: dict = None,
+               capture: int = 0):
+        """
+        Records a capture which was just written. `capture` is the index of the
+        capture in a binary file, the size is the size of the file for CSV files
+        and the size of the record for binary files. Without `acc_data`, e.g. for
+        a streamed capture, the statistics are left empty.
+
+        """
+        if path.endswith('.bin'):
+            num_samples = len(acc_data) if acc_data is not None else sample_info.num_of_acq_samples
+            data_size = num_samples * 3 * BinaryCapture.SAMPLE_DTYPE.itemsize
+            size_bytes = BinaryCapture.HEADER_SIZE + data_size + BinaryCapture._padding(data_size)
+            file_format = 'bin'
+        else:
+            size_bytes = os.path.getsize(path)
+            file_format = 'csv'
+        self._insert([self._row(path, capture, file_format, time.time(), sample_info, params, size_bytes,
+                                acc_data)])
+
+    def backfill(self, directory: str, with_stats: bool = False) -> int:
+        """
+        Adds the capture files under `directory` which are not in the catalog yet,
+        from their headers. With `with_stats` the samples are read for the statistics,
+        binary captures always get them, their samples are memory-mapped.
+        Returns the number of added captures.
+
+        """
+        with closing(self._connect()) as db:
+            known_sizes = dict(db.execute('SELECT path, SUM(size_bytes) FROM captures GROUP BY path'))
+
+        rows = []
+        for path in sorted(glob.glob(os.path.join(directory, '**', '*.csv'), recursive=True)):
+            if os.path.abspath(path) in known_sizes:
+                continue
+            try:
+                if with_stats:
+                    record = CsvCapture.read(path, sidecar=False)
+                else:
+                    record = CsvCapture.read_header(path)
+                rows.append(self._row(path, 0, 'csv', record.timestamp, record.sample_info, None,
+                                      os.path.getsize(path), record.samples))
+            except Exception as e:
+                logger.warning(f'Skipping {path}: {e}')
+
+        for path in sorted(glob.glob(os.path.join(directory, '**', '*.bin'), recursive=True)):
+            # Binary files grow while a run appends to them
+            if known_sizes.get(os.path.abspath(path)) == os.path.getsize(path):
+                continue
+            try:
+                for capture, record in enumerate(BinaryCapture.read(path)):
+                    data_size = record.samples.nbytes
+                    size_bytes = BinaryCapture.HEADER_SIZE + data_size + BinaryCapture._padding(data_size)
+                    rows.append(self._row(path, capture, 'bin', record.timestamp, record.sample_info, None,
+                                          size_bytes, record.samples))
+            except Exception as e:
+                logger.warning(f'Skipping {path}: {e}')
+
+        self._insert(rows)
+        logger.info(f'Catalog back-fill added {len(rows)} captures from {directory}')
+        return len(rows)
+
+    def query(self, accelerometer_id=None, accelerometer_scale: int = None, sampling_frequency: float = None,
+              since: float = None, until: float = None, file_format: str = None, limit: int = None) -> list:
+        """
+        Returns the CatalogEntry of every capture matching all given conditions,
+        newest first. `since` and `until` are timestamps or datetimes.
+
+        """
+        conditions = []
+        values = []
+        if accelerometer_id is not None:
+            conditions.append('accelerometer_id = ?')
+            values.append(accelerometer_id)
+        if accelerometer_scale is not None:
+            conditions.append('accelerometer_scale = ?')
+            values.append(accelerometer_scale)
+        if sampling_frequency is not None:
+            conditions.append('sampling_frequency BETWEEN ? AND ?')
+            values += [sampling_frequency - self.FREQUENCY_TOLERANCE_HZ,
+                       sampling_frequency + self.FREQUENCY_TOLERANCE_HZ]
+        for column, operator, value in (('created', '>=', since), ('created', '<', until)):
+            if value is not None:
+                conditions.append(f'{column} {operator} ?')
+                values.append(value.timestamp() if isinstance(value, datetime) else value)
+        if file_format is not None:
+            conditions.append('format = ?')
+            values.append(file_format)
+
+        sql = f'SELECT {", ".join(self.COLUMNS)} FROM captures'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY created DESC'
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+
+        with closing(self._connect()) as db:
+            rows = db.execute(sql, values).fetchall()
+        return [CatalogEntry(path=row[0], capture=row[1], format=row[2], created=row[3],
+                             sample_info=SampleInfo(*row[4:9]),
+                             params=json.loads(row[9]) if row[9] else None,
+                             size_bytes=row[10], mean=row[11:14], rms=row[14:17], peak=row[17:20])
+                for row in rows]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the capture catalog')
+    parser.add_argument('catalog', help='Catalog database file')
+    parser.add_argument('--backfill', type=str, default='',
+                        help='Add the capture files of this directory before querying')
+    parser.add_argument('--stats', action='store_true', help='Read CSV samples for statistics when back-filling')
+    parser.add_argument('--accelerometer', type=int, default=None)
+    parser.add_argument('--scale', type=int, default=None, help='Accelerometer scale setting')
+    parser.add_argument('--frequency', type=float, default=None, help='Sampling frequency [Hz]')
+    parser.add_argument('--since', type=datetime.fromisoformat, default=None, help='ISO date or time')
+    parser.add_argument('--until', type=datetime.fromisoformat, default=None, help='ISO date or time')
+    parser.add_argument('--limit', type=int, default=None)
+    args = parser.parse_args()
+    setup_logging(level=logging.INFO, log_file='')
+
+    catalog = CaptureCatalog(args.catalog)
+    if args.backfill:
+        catalog.backfill(args.backfill, with_stats=args.stats)
+
+    start_time = time.perf_counter()
+    entries = catalog.query(accelerometer_id=args.accelerometer, accelerometer_scale=args.scale,
+                            sampling_frequency=args.frequency, since=args.since, until=args.until,
+                            limit=args.limit)
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+    for entry in entries:
+        created = datetime.fromtimestamp(entry.created).isoformat(sep=' ', timespec='seconds')
+        print(f'{created}  {entry.path}#{entry.capture}  acc={entry.sample_info.accelerometer_id} '
+              f'scale={entry.sample_info.accelerometer_scale} fs={entry.sample_info.sampling_frequency:g} '
+              f'n={entry.sample_info.num_of_acq_samples}')
+    print(f'{len(entries)} captures ({elapsed_ms:.1f} ms)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import logging
+import os
+import warnings
+
+import numpy as np
+
+from lib.logging_config import logger
+from lib.BinaryCapture import CaptureRecord
+from lib.DeviceProtocol import SampleInfo
+from lib.vibration_metrics import SCALE_RANGES_G
+
+
+logger = logging.getLogger(__name__)
+
+
+class CsvCapture:
+    """
+    Semicolon separated capture file written by AccController.save_to_file: the sample
+    info in the first four lines, the 'x;y;z' title line and one line per sample.
+    The samples are parsed once, later reads memory-map the .npy sidecar written
+    next to the file.
+
+    """
+    HEADER_LINES = 5
+    SAMPLE_DTYPE = np.dtype('<i2')
+    SIDECAR_SUFFIX = '.npy'
+
+    @classmethod
+    def _parse_header(cls, filename: str, lines: list) -> tuple:
+        try:
+            acc_name, frequency, num_samples = lines[1].strip().split(';')
+            scale_g, bits_per_sample, acquisition_time = lines[3].strip().split(';')
+        except ValueError:
+            raise Exception(f'Invalid capture header in {filename}')
+        if lines[4].strip() != 'x;y;z':
+            raise Exception(f'Invalid capture header in {filename}')
+
+        # The scale is written in g, the sample info holds the scale setting
+        scales = {f'{range_g:g}': scale for scale, range_g in SCALE_RANGES_G.items()}
+        sample_info = SampleInfo(accelerometer_id=int(acc_name) if acc_name.isdigit() else acc_name,
+                                 accelerometer_scale=scales.get(scale_g),
+                                 sampling_frequency=float(frequency),
+                                 num_of_acq_samples=int(num_samples),
+                                 acquisition_time=int(acquisition_time))
+        return sample_info, int(bits_per_sample) if bits_per_sample.isdigit() else None
+
+    @classmethod
+    def read_header(cls, filename: str) -> CaptureRecord:
+        """
+        Returns the CaptureRecord of the file without its samples, the timestamp is
+        the modification time of the file.
+
+        """
+        with open(filename) as f:
+            lines = [f.readline() for _ in range(cls.HEADER_LINES)]
+        sample_info, bits_per_sample = cls._parse_header(filename, lines)
+        return CaptureRecord(sample_info, bits_per_sample, os.path.getmtime(filename), None)
+
+    @classmethod
+    def _parse_samples(cls, filename: str, f) -> np.ndarray:
+        # np.loadtxt tokenizes in C and converts whole columns at once
+        try:
+            with warnings.catch_warnings():
+                # Captures without samples are valid
+                warnings.simplefilter('ignore', UserWarning)
+                samples = np.loadtxt(f, dtype=cls.SAMPLE_DTYPE, delimiter=';', ndmin=2)
+        except (ValueError, OverflowError) as e:
+            raise Exception(f'Invalid sample data in {filename}: {e}')
+        if not samples.size:
+            return np.empty((0, 3), dtype=cls.SAMPLE_DTYPE)
+        if samples.shape[1] != 3:
+            raise Exception(f'Invalid sample data in {filename}: {samples.shape[1]} columns')
+        return samples
+
+    @classmethod
+    def sidecar_filename(cls, filename: str) -> str:
+        return filename + cls.SIDECAR_SUFFIX
+
+    @classmethod
+    def _load_sidecar(cls, filename: str, num_samples: int):
+        # The sidecar carries the modification time of its CSV file and has to hold
+        # exactly the samples the header announces, anything else is stale
+        sidecar = cls.sidecar_filename(filename)
+        try:
+            if os.stat(sidecar).st_mtime_ns != os.stat(filename).st_mtime_ns:
+                return None
+            samples = np.load(sidecar, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        if samples.dtype != cls.SAMPLE_DTYPE or samples.shape != (num_samples, 3):
+            return None
+        return samples
+
+    @classmethod
+    def _write_sidecar(cls, filename: str, samples: np.ndarray):
+        sidecar = cls.sidecar_filename(filename)
+        try:
+            np.save(sidecar, samples)
+            source_stat = os.stat(filename)
+            os.utime(sidecar, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+        except OSError as e:
+            logger.warning(f'Could not write sidecar {sidecar}: {e}')
+
+    @classmethod
+    def read(cls, filename: str, sidecar: bool = True) -> CaptureRecord:
+        """
+        Returns the CaptureRecord of the file with its samples as an int16 (N, 3) array.
+        With `sidecar` the samples are memory-mapped from the .npy sidecar when it is
+        up to date, otherwise the CSV is parsed and the sidecar is written.
+
+        """
+        with open(filename, 'rb') as f:
+            lines = [f.readline().decode() for _ in range(cls.HEADER_LINES)]
+            sample_info, bits_per_sample = cls._parse_header(filename, lines)
+            timestamp = os.path.getmtime(filename)
+
+            if sidecar:
+                samples = cls._load_sidecar(filename, sample_info.num_of_acq_samples)
+                if samples is not None:
+                    return CaptureRecord(sample_info, bits_per_sample, timestamp, samples)
+
+            samples = cls._parse_samples(filename, f)
+
+        if len(samples) != sample_info.num_of_acq_samples:
+            raise Exception(f'{filename} holds {len(samples)} samples, '
+                            f'the header announces {sample_info.num_of_acq_samples}')
+        if sidecar:
+            cls._write_sidecar(filename, samples)
+        return CaptureRecord(sample_info, bits_per_sample, timestamp, samples)
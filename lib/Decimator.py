@@ -0,0 +1,186 @@
+import argparse
+import logging
+import os
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from lib.logging_config import logger, setup_logging
+from lib.BinaryCapture import BinaryCapture
+from lib.CsvCapture import CsvCapture
+
+
+logger = logging.getLogger(__name__)
+
+
+class Decimator:
+    """
+    Host-side anti-alias filter and decimation by an integer factor of x/y/z sample
+    batches ((N, 3) arrays). The filter state and the decimation phase are kept
+    between calls, so a capture fed batch by batch, e.g. from
+    AccController.iter_sample_batches, gives the same output as in one piece.
+
+    The FIR filter is evaluated polyphase, only at the samples that are kept. The
+    IIR filter (Chebyshev type I, like scipy.signal.decimate) is cheaper for large
+    factors but not linear phase. Both are causal, the FIR output is delayed by
+    (numtaps - 1) / 2 input samples.
+
+    """
+    FILTER_TYPES = ('fir', 'iir')
+    # FIR taps per unit of decimation factor
+    FIR_TAPS_PER_FACTOR = 10
+    IIR_ORDER = 8
+    IIR_RIPPLE_DB = 0.05
+    # Cut-off as a fraction of the output Nyquist frequency
+    CUTOFF = 0.8
+
+    def __init__(self, factor: int, filter_type: str = 'fir', numtaps: int = None):
+        if factor < 1:
+            raise Exception(f'Invalid decimation factor: {factor}')
+        if filter_type not in self.FILTER_TYPES:
+            raise Exception(f'Invalid filter type: {filter_type}')
+        self.factor = factor
+        self.filter_type = filter_type
+        self.numtaps = numtaps or self.FIR_TAPS_PER_FACTOR * factor + 1
+        self.taps = None
+        self.sos = None
+        self._sosfilt = None
+
+        if factor > 1:
+            # scipy is only loaded when a filter is designed
+            from scipy import signal
+            if filter_type == 'fir':
+                # Reversed, the windows of the input are multiplied with them directly
+                self.taps = signal.firwin(self.numtaps, self.CUTOFF / factor)[::-1].copy()
+            else:
+                self.sos = signal.cheby1(self.IIR_ORDER, self.IIR_RIPPLE_DB, self.CUTOFF / factor, output='sos')
+                self._sosfilt = signal.sosfilt
+        self.reset()
+
+    def reset(self):
+        """
+        Clears the filter state, the next batch starts a new capture.
+
+        """
+        # Index in the next batch of the next kept sample
+        self._phase = 0
+        self._history = np.zeros((self.numtaps - 1, 3)) if self.taps is not None else None
+        self._zi = np.zeros((self.sos.shape[0], 2, 3)) if self.sos is not None else None
+
+    def output_frequency(self, sampling_frequency: float) -> float:
+        return sampling_frequency / self.factor
+
+    def process(self, samples: np.ndarray) -> np.ndarray:
+        """
+        Filters and decimates the next batch of the capture, returns the float64
+        (M, 3) output samples in counts, M is about len(samples) / factor.
+
+        """
+        samples = np.asarray(samples, dtype=np.float64).reshape(-1, 3)
+        if self.factor == 1 or not len(samples):
+            return samples
+
+        phase = self._phase
+        self._phase = (phase - len(samples)) % self.factor
+        if self.taps is not None:
+            extended = np.concatenate((self._history, samples))
+            self._history = extended[len(samples):].copy()
+            # Window i ends at sample i of the batch, only every factor-th one is kept
+            windows = sliding_window_view(extended, self.numtaps, axis=0)[phase::self.factor]
+            return windows @ self.taps
+
+        filtered, self._zi = self._sosfilt(self.sos, samples, axis=0, zi=self._zi)
+        return filtered[phase::self.factor]
+
+
+class MultiRateDecimator:
+    """
+    Produces several output rates of a capture in one pass: a cascade of Decimator
+    stages, each one fed by the output of the previous one, so every stage only
+    filters at the rate it receives. Every factor has to be a multiple of the
+    next smaller one.
+
+    """
+    def __init__(self, factors, filter_type: str = 'fir'):
+        self.factors = sorted(set(factors))
+        if not self.factors or self.factors[0] < 1:
+            raise Exception(f'Invalid decimation factors: {factors}')
+        self.stages = []
+        previous = 1
+        for factor in self.factors:
+            if factor % previous:
+                raise Exception(f'Decimation factor {factor} is not a multiple of {previous}')
+            self.stages.append(Decimator(factor // previous, filter_type))
+            previous = factor
+
+    def reset(self):
+        for stage in self.stages:
+            stage.reset()
+
+    def process(self, samples: np.ndarray) -> dict:
+        """
+        Returns {factor: output samples} for the next batch of the capture.
+
+        """
+        outputs = {}
+        for factor, stage in zip(self.factors, self.stages):
+            samples = stage.process(samples)
+            outputs[factor] = samples
+        return outputs
+
+    def process_batches(self, sample_batches) -> dict:
+        """
+        Runs a whole capture given as an iterable of batches through the stages,
+        returns {factor: all output samples}.
+
+        """
+        self.reset()
+        outputs = {factor: [] for factor in self.factors}
+        for sample_batch in sample_batches:
+            for factor, samples in self.process(sample_batch).items():
+                outputs[factor].append(samples)
+        return {factor: np.concatenate(chunks) if chunks else np.empty((0, 3))
+                for factor, chunks in outputs.items()}
+
+
+def to_samples(acc_data: np.ndarray) -> np.ndarray:
+    """
+    Rounds filtered data back to int16 samples, e.g. for BinaryCapture.
+
+    """
+    info = np.iinfo(BinaryCapture.SAMPLE_DTYPE)
+    return np.clip(np.rint(acc_data), info.min, info.max).astype(BinaryCapture.SAMPLE_DTYPE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Decimate captures to lower sampling rates on the host')
+    parser.add_argument('files', nargs='+', help='CSV or binary capture files')
+    parser.add_argument('--factors', type=int, nargs='+', required=True,
+                        help='Decimation factors, each a multiple of the next smaller one')
+    parser.add_argument('--filter', choices=Decimator.FILTER_TYPES, default='fir',
+                        help='Anti-alias filter (default: fir)')
+    parser.add_argument('--chunk', type=int, default=65536, help='Samples filtered at once (default: 65536)')
+    args = parser.parse_args()
+    setup_logging(level=logging.INFO, log_file='')
+
+    decimator = MultiRateDecimator(args.factors, args.filter)
+    for filename in args.files:
+        records = BinaryCapture.read(filename) if filename.endswith('.bin') else [CsvCapture.read(filename)]
+        outputs = {factor: f'{os.path.splitext(filename)[0]}_dec{factor}.bin' for factor in decimator.factors}
+        # The outputs are derived from the file, they are written again from scratch
+        for output in outputs.values():
+            if os.path.exists(output):
+                os.remove(output)
+        for record in records:
+            # Memory-mapped samples are read chunk by chunk
+            chunks = (record.samples[start:start + args.chunk] for start in range(0, len(record.samples), args.chunk))
+            for factor, acc_data in decimator.process_batches(chunks).items():
+                sample_info = record.sample_info._replace(
+                    sampling_frequency=record.sample_info.sampling_frequency / factor,
+                    num_of_acq_samples=len(acc_data))
+                BinaryCapture.append(outputs[factor], sample_info, to_samples(acc_data))
+        logger.info(f'Decimated {len(records)} captures of {filename} by {", ".join(map(str, decimator.factors))}')
+
+
+if __name__ == '__main__':
+    main()
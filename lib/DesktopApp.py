@@ -1,20 +1,34 @@
 import tkinter as tk
 from tkinter import ttk
 import logging
+import queue
+import threading
 
-from lib.AccTestApp import AccTestApp
 from lib.logging_config import logger
+from lib.AccController import DownloadCancelled
+from lib.AccTestApp import Progress
+from lib.LinkCalibrator import LinkCalibrator
+from lib.LivePlot import LivePlot
+from lib.SessionManager import SessionManager
 
 
 logger = logging.getLogger(__name__)
 
 
 class DesktopApp:
+    # How often the worker events are polled from the Tk loop
+    POLL_INTERVAL_MS = 50
+
     def __init__(self, root):
         logger.info('Starting Desktop App...')
         self.param_dict = {}
+        self.app = None
+        # Progress and finish events sent from the worker thread
+        self.events = queue.Queue()
         self.root = root
         self.root.title("Acc test app")
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+        self.sessions = SessionManager()
 
         # Parametry
         self.params = {
@@ -28,7 +42,15 @@ class DesktopApp:
             "AcqTimSampleRate": tk.IntVar(value=8000),
             "AcqODRRun": tk.BooleanVar(value=False),
             "AcqTimerRun": tk.BooleanVar(value=True),
-            "LoopTimes": tk.IntVar(value=1)
+            "LoopTimes": tk.IntVar(value=1),
+            "BatchWindow": tk.IntVar(value=1),
+            "ReaderThread": tk.BooleanVar(value=False),
+            "Continuous": tk.BooleanVar(value=False),
+            "Format": tk.StringVar(value="csv"),
+            "BatchCommands": tk.BooleanVar(value=False),
+            "Calibrate": tk.BooleanVar(value=False),
+            "Stream": tk.BooleanVar(value=False),
+            "Catalog": tk.StringVar(value="")
         }
 
         self.create_widgets()
@@ -49,12 +71,12 @@ class DesktopApp:
                                   sticky="w", padx=5, pady=5)
             elif isinstance(var, tk.IntVar):
                 if "baudrate" in param.lower():
-                    ttk.Combobox(frame, textvariable=var, values=[230400]).grid(
+                    ttk.Combobox(frame, textvariable=var, values=list(LinkCalibrator.BAUDRATES)).grid(
                         row=row, column=1, sticky="w", padx=5, pady=5)
-                if "selectacc" in param.lower():
+                elif "selectacc" in param.lower():
                     ttk.Combobox(frame, textvariable=var, values=[1, 2, 3, 4]).grid(
                         row=row, column=1, sticky="w", padx=5, pady=5)
-                if "accscale" in param.lower():
+                elif "accscale" in param.lower():
                     ttk.Combobox(frame, textvariable=var, values=[0, 1, 2, 3]).grid(
                         row=row, column=1, sticky="w", padx=5, pady=5)
                 else:
@@ -67,7 +89,20 @@ class DesktopApp:
 
         self.run_button = ttk.Button(
             frame, text="Run", command=self.run_application)
-        self.run_button.grid(row=row, column=0, columnspan=2, pady=10)
+        self.run_button.grid(row=row, column=0, pady=10)
+        self.cancel_button = ttk.Button(
+            frame, text="Cancel", command=self.cancel_application, state="disabled")
+        self.cancel_button.grid(row=row, column=1, pady=10)
+        row += 1
+
+        self.progress_bar = ttk.Progressbar(frame, length=300, mode="determinate")
+        self.progress_bar.grid(row=row, column=0, columnspan=2, padx=5, pady=5)
+        row += 1
+        self.progress_label = ttk.Label(frame, text="")
+        self.progress_label.grid(row=row, column=0, columnspan=2, sticky="w", padx=5)
+
+        self.live_plot = LivePlot(self.root)
+        self.live_plot.grid(row=0, column=1, sticky="nsew")
 
     def update_check_buttons(self):
         """
@@ -90,17 +125,88 @@ class DesktopApp:
             self.param_dict = param_dict
             init = True
 
-        app = AccTestApp(self.param_dict)
-        self.root.after(100, lambda: self.execute_task(app, init))
+        app, connected = self.sessions.get_app(self.param_dict)
+        init = init or connected
+
+        self.app = app
+        app.progress_callback = self.events.put
+        self.cancel_button.config(state="normal")
+        self.progress_bar.config(value=0)
+        self.progress_label.config(text="")
+        self.live_plot.clear()
+        threading.Thread(target=self.execute_task, args=(app, init), name='AccWorker', daemon=True).start()
+        self.root.after(self.POLL_INTERVAL_MS, self.poll_events)
+
+    def cancel_application(self):
+        if self.app is not None:
+            self.app.cancel()
+        self.cancel_button.config(state="disabled")
 
     def execute_task(self, app, init:bool):
+        """
+        Runs on the worker thread, the result is sent to the Tk loop as the last event.
+        """
         try:
             if init:
                 app.init()
 
             app.run()
-        finally:
-            self.run_button.config(state="normal", text="Run")
+            self.events.put(None)
+        except Exception as e:
+            self.events.put(e)
+
+    def poll_events(self):
+        # Only the latest progress of every poll is drawn
+        progress = None
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+
+            if isinstance(event, Progress):
+                progress = event
+            else:
+                if progress is not None:
+                    self.show_progress(progress)
+                self.finish_task(event)
+                return
+
+        if progress is not None:
+            self.show_progress(progress)
+        self.root.after(self.POLL_INTERVAL_MS, self.poll_events)
+
+    def show_progress(self, progress: Progress):
+        self.live_plot.update(progress.samples, progress.sampling_frequency,
+                              complete=progress.batches_done == progress.num_batches)
+        self.progress_bar.config(maximum=progress.num_batches, value=progress.batches_done)
+        self.progress_label.config(
+            text=f"Loop {progress.iteration + 1}/{progress.loop_times}: "
+                 f"batch {progress.batches_done}/{progress.num_batches}, "
+                 f"{progress.bytes_per_s / 1024:.1f} kB/s, ETA {progress.eta_s:.1f}s")
+
+    def finish_task(self, error):
+        if isinstance(error, DownloadCancelled):
+            self.progress_label.config(text="Cancelled")
+        elif error is not None:
+            # Reconnect and initialize again on the next run, the device state is unknown
+            self.param_dict = {}
+            self.sessions.close(self.app.device.port)
+            logger.error(f'Run failed: {error}')
+            self.progress_label.config(text=f"Error: {error}")
+        self.app.progress_callback = None
+        self.app = None
+        self.cancel_button.config(state="disabled")
+        self.run_button.config(state="normal", text="Run")
+
+    def close(self):
+        """
+        Releases all serial ports before the window is destroyed.
+        """
+        if self.app is not None:
+            self.app.cancel()
+        self.sessions.close_all()
+        self.root.destroy()
 
     def __del__(self):
         logger.info('Desktop App finished.')
@@ -0,0 +1,222 @@
+import logging
+import os
+import pty
+import random
+import select
+import threading
+import time
+import tty
+
+import numpy as np
+
+from lib.logging_config import logger
+from lib.DeviceProtocol import DeviceProtocol
+
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceEmulator:
+    """
+    Emulates the accelerometer firmware behind a pseudo terminal (POSIX only).
+    SerialDevice connects to `port` like to a real device. Replies can be throttled
+    to a baud rate and delayed by a fixed latency plus random jitter. A fraction of the
+    sample packages can be truncated to emulate bytes lost on the link, above
+    `max_stable_baudrate` a quarter of them is. Another fraction can be sent
+    `delay_s` late, e.g. after the host stopped waiting for it.
+
+    """
+    FIRMWARE_VERSION = 'emulator-1.0'
+    # Bytes written at once when the reply is throttled to the baud rate
+    THROTTLE_CHUNK = 32
+    BAUDRATES = (230400, 460800, 921600)
+    MAX_BATCH_SIZE = 256
+
+    def __init__(self, baudrate: int = None, latency_s: float = 0.0, jitter_s: float = 0.0,
+                 acquisition_delay: bool = False, drop_rate: float = 0.0, max_stable_baudrate: int = None,
+                 delay_rate: float = 0.0, delay_s: float = 0.0, seed: int = None):
+        self.baudrate = baudrate
+        self.latency_s = latency_s
+        self.jitter_s = jitter_s
+        self.acquisition_delay = acquisition_delay
+        self.drop_rate = drop_rate
+        self.max_stable_baudrate = max_stable_baudrate
+        self.delay_rate = delay_rate
+        self.delay_s = delay_s
+        self.batch_size = DeviceProtocol.SAMPLES_PER_BATCH
+        self._next_baudrate = None
+        self.random = random.Random(seed)
+        self.rng = np.random.default_rng(seed)
+
+        self.port = None
+        self._master_fd = None
+        self._slave_fd = None
+        self._thread = None
+        self._stop = threading.Event()
+
+        self.settings = {
+            'selectacc': 1,
+            'ovraccspispeed': 0,
+            'accscale': 0,
+            'accodr': 0,
+            'acqnumsamples': 1024,
+            'acqdecfactor': 1,
+            'acqtimsamplerate': 8000,
+        }
+        self.initialized = False
+        self.samples = np.zeros((0, 3), dtype=DeviceProtocol.SAMPLE_DTYPE)
+        self.acquisition_time_ms = 0
+
+        self.commands_handled = 0
+        self.bytes_sent = 0
+        self.packages_dropped = 0
+        self.packages_delayed = 0
+
+    def start(self) -> str:
+        self._master_fd, self._slave_fd = pty.openpty()
+        tty.setraw(self._slave_fd)
+        self.port = os.ttyname(self._slave_fd)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._serve, name='DeviceEmulator', daemon=True)
+        self._thread.start()
+        logger.debug(f'Device emulator listening on {self.port}')
+        return self.port
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        for fd in (self._master_fd, self._slave_fd):
+            if fd is not None:
+                os.close(fd)
+        self._master_fd = self._slave_fd = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def _serve(self):
+        pending = b''
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self._master_fd], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                pending += os.read(self._master_fd, 4096)
+            except OSError:
+                break
+            received_time = time.perf_counter()
+            while b'\n' in pending:
+                line, pending = pending.split(b'\n', 1)
+                reply = self._handle(line.decode(errors='replace').strip())
+                self.commands_handled += 1
+                self._write(reply, received_time)
+                if self._next_baudrate:
+                    # An unthrottled emulator stays unthrottled
+                    if self.baudrate:
+                        self.baudrate = self._next_baudrate
+                    self._next_baudrate = None
+
+    def _write(self, reply: bytes, received_time: float):
+        # Latency delays the reply relative to its request, pipelined requests
+        # do not wait for each other's latency, only for the link
+        send_time = received_time + self.latency_s + self.random.uniform(0, self.jitter_s)
+        remaining = send_time - time.perf_counter()
+        if remaining > 0:
+            time.sleep(remaining)
+        if not self.baudrate:
+            os.write(self._master_fd, reply)
+        else:
+            # 8N1 framing, 10 bits on the wire per byte
+            byte_time = 10.0 / self.baudrate
+            next_time = time.perf_counter()
+            for i in range(0, len(reply), self.THROTTLE_CHUNK):
+                chunk = reply[i:i + self.THROTTLE_CHUNK]
+                os.write(self._master_fd, chunk)
+                next_time += len(chunk) * byte_time
+                remaining = next_time - time.perf_counter()
+                if remaining > 0:
+                    time.sleep(remaining)
+        self.bytes_sent += len(reply)
+
+    def _handle(self, line: str) -> bytes:
+        fields = line.split()
+        if not fields:
+            return b':er\n'
+        command, args = fields[0], fields[1:]
+
+        if command == 'getfwver':
+            return f':ok {self.FIRMWARE_VERSION}\n'.encode()
+        if command in self.settings and len(args) == 1:
+            try:
+                self.settings[command] = int(args[0])
+            except ValueError:
+                return b':er\n'
+            self.initialized = False
+            return b':ok\n'
+        if command == 'acqbatchsize' and len(args) == 1:
+            if not args[0].isdigit() or not 1 <= int(args[0]) <= self.MAX_BATCH_SIZE:
+                return b':er\n'
+            self.batch_size = int(args[0])
+            return b':ok\n'
+        if command == 'uartbaudrate' and len(args) == 1:
+            if not args[0].isdigit() or int(args[0]) not in self.BAUDRATES:
+                return b':er\n'
+            # Acknowledged at the old rate, the pty does not care about the host's rate
+            self._next_baudrate = int(args[0])
+            return b':ok\n'
+        if command == 'accinit':
+            self.initialized = True
+            return b':ok\n'
+        if command in ('acqtimerrun', 'acqodrrun'):
+            if not self.initialized:
+                return b':er\n'
+            self._acquire()
+            return b':ok\n'
+        if command == 'acqgetinfo':
+            return (f':ok {self.settings["selectacc"]} {self.settings["accscale"]} '
+                    f'{self._sampling_frequency():.2f} {len(self.samples)} {self.acquisition_time_ms}\n').encode()
+        if command == 'acqgetbatch' and len(args) == 1:
+            return self._sample_package(int(args[0]))
+        return b':er\n'
+
+    def _sampling_frequency(self) -> float:
+        return self.settings['acqtimsamplerate'] / max(1, self.settings['acqdecfactor'])
+
+    def _acquire(self):
+        num_samples = self.settings['acqnumsamples']
+        frequency = self._sampling_frequency()
+        self.acquisition_time_ms = int(num_samples * 1000 / frequency)
+        if self.acquisition_delay:
+            time.sleep(self.acquisition_time_ms / 1000)
+
+        # 80 Hz vibration with noise, a different phase on every axis
+        t = np.arange(num_samples)[:, np.newaxis] / frequency
+        phases = np.array([0.0, np.pi / 2, np.pi])
+        signal = 4000 * np.sin(2 * np.pi * 80 * t + phases) + self.rng.normal(0, 200, (num_samples, 3))
+        self.samples = np.clip(signal, -32768, 32767).astype(DeviceProtocol.SAMPLE_DTYPE)
+
+    def _sample_package(self, sample_batch_no: int) -> bytes:
+        batch_size = self.batch_size
+        start = sample_batch_no * batch_size
+        if sample_batch_no < 0 or start >= len(self.samples):
+            return b':er\n'
+        batch = np.zeros((batch_size, 3), dtype=DeviceProtocol.SAMPLE_DTYPE)
+        data = self.samples[start:start + batch_size]
+        batch[:len(data)] = data
+        package = DeviceProtocol.SAMPLE_PACKAGE_HEADER + batch.tobytes()
+        drop_rate = self.drop_rate
+        if self.max_stable_baudrate and self.baudrate and self.baudrate > self.max_stable_baudrate:
+            drop_rate = max(drop_rate, 0.25)
+        if drop_rate and self.random.random() < drop_rate:
+            self.packages_dropped += 1
+            return package[:self.random.randrange(len(package))]
+        if self.delay_rate and self.random.random() < self.delay_rate:
+            # The device is busy, the following requests wait behind this one
+            self.packages_delayed += 1
+            time.sleep(self.delay_s)
+        return package
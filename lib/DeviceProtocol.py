@@ -1,125 +1,417 @@
 import logging
 import struct
 import time
-from collections import namedtuple
+from collections import deque, namedtuple
+
+import numpy as np
 
 from lib.logging_config import logger
+from lib.metrics import registry
 from lib.SerialDevice import SerialDevice
+from lib.utils import measure_time
 
 logger = logging.getLogger(__name__)
 
+SampleInfo = namedtuple('SampleInfo', ['accelerometer_id',
+                                       'accelerometer_scale',
+                                       'sampling_frequency',
+                                       'num_of_acq_samples',
+                                       'acquisition_time'])
+
+
+class CommandTiming:
+    """
+    Round trip time profile of one command: EWMA of the round trip time and of
+    its deviation, the deadline is the mean plus four deviations.
+
+    """
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    DEVIATIONS = 4
+    MIN_DEADLINE_S = 0.02
+
+    def __init__(self):
+        self.samples = 0
+        self.misses = 0
+        self.rtt_s = None
+        self.rtt_deviation_s = None
+
+    def update(self, rtt_s: float):
+        self.samples += 1
+        if self.rtt_s is None:
+            self.rtt_s = rtt_s
+            self.rtt_deviation_s = rtt_s / 2
+        else:
+            self.rtt_deviation_s += self.BETA * (abs(rtt_s - self.rtt_s) - self.rtt_deviation_s)
+            self.rtt_s += self.ALPHA * (rtt_s - self.rtt_s)
 
-class DeviceProtocol:
+    def deadline(self, max_s: float) -> float:
+        """
+        Returns the learned deadline, or max_s while nothing was measured yet.
+        """
+        if self.rtt_s is None:
+            return max_s
+        return min(max(self.rtt_s + self.DEVIATIONS * self.rtt_deviation_s, self.MIN_DEADLINE_S), max_s)
+
+    def poll_interval(self) -> float:
+        # Poll a few times per expected round trip in polling mode
+        return min(max(self.rtt_s / 4, 0.0005), 0.25)
+
+    def stats(self) -> dict:
+        return {
+            'samples': self.samples,
+            'misses': self.misses,
+            'rtt_s': self.rtt_s,
+            'rtt_deviation_s': self.rtt_deviation_s,
+            'deadline_s': self.deadline(float('inf')) if self.rtt_s is not None else None,
+        }
+
+
+class DeviceCommands:
+    """
+    Setting and acquisition commands of the device, shared by DeviceProtocol and
+    AsyncDeviceProtocol. Every command goes through _send_setting, which returns the
+    reply in DeviceProtocol and an awaitable of it in AsyncDeviceProtocol.
+
+    """
     INIT_ACC_TIMEOUT_S = 1
     DATA_ACQUISITION_MAX_TIME_S = 1 * 60 * 10
 
-    def __init__(self, serial_device: SerialDevice):
-        self.serial_device = serial_device
-        self.serial_device.connect()
-
-    def _send_command(self, command: str, timeout: int = 0.3, batch_download: bool = False) -> str:
-        self.serial_device.send(command, timeout)
-        if not batch_download:
-            for _ in range(40):
-                # max time 10s
-                response = self.serial_device.receive()
-                if not response:
-                    time.sleep(0.25)
-                else: 
-                    break
-        else:
-            response = self.serial_device.receive_package()
-        return response
-
-    def get_firmware_version(self):
-        '''
-        Returns the firmware version of the device.
-
-        Returns:
-            str: The firmware version of the device.
-
-        '''
-        return "An response"
-
-    def check_connection(self) -> bool:
-        return False
-
     def select_accelerometer(self, acc_id):
         """
         Selects the accelerometer by its ID.
 
         """
-        return "An response"
+        return self._send_setting(f'selectacc {acc_id}\n')
 
     def override_acc_spi_speed(self, ovr_acc_spi_speed):
         """
         Overrides the SPI speed of the accelerometer.
 
         """
-        return "An response"
+        return self._send_setting(f'ovraccspispeed {ovr_acc_spi_speed}\n')
 
     def set_accelerometer_scale(self, scale):
         """
         Sets the scale of the accelerometer.
 
         """
-        return "An response"
+        return self._send_setting(f'accscale {scale}\n')
 
     def set_accelerometer_odr(self, odr):
         """
         Sets the Output Data Rate (ODR) of the accelerometer.
 
         """
-        return "An response"
+        return self._send_setting(f'accodr {odr}\n')
 
     def set_num_samples_to_acquire(self, num_samples):
         """
         Sets the number of samples the accelerometer should acquire.
 
         """
-        return "An response"
+        return self._send_setting(f'acqnumsamples {num_samples}\n')
 
     def set_decimation_factor(self, decimation_factor):
         """
         Sets the decimation factor for the accelerometer's data acquisition.
 
         """
-        return "An response"
+        return self._send_setting(f'acqdecfactor {decimation_factor}\n')
 
     def set_timer_sample_rate(self, timer_sample_rate):
         """
         Sets the sample rate for the timer-based data acquisition.
 
         """
-        return "An response"
+        return self._send_setting(f'acqtimsamplerate {timer_sample_rate}\n')
 
     def init_accelerometer(self):
         """
         Initializes the accelerometer. Before that, you need to set the parameters.
 
         """
-        return "An response"
+        return self._send_setting('accinit\n', timeout=self.INIT_ACC_TIMEOUT_S)
 
     def run_data_acquisition_odr(self):
-        return "An response"
+        return self._send_setting('acqodrrun\n', response_timeout=self.DATA_ACQUISITION_MAX_TIME_S)
 
     def run_data_acquisition_timer(self):
-        return "An response"
-    
-    def get_sample_batch(self, sample_batch_no) -> list:
+        return self._send_setting('acqtimerrun\n', response_timeout=self.DATA_ACQUISITION_MAX_TIME_S)
+
+
+class DeviceProtocol(DeviceCommands):
+    # Default batch size, used until another one is negotiated with set_batch_size
+    SAMPLES_PER_BATCH = 32
+    # ':ok\n' header followed by 32 samples of 3 x int16
+    SAMPLE_PACKAGE_HEADER = b':ok\n'
+    SAMPLE_PACKAGE_SIZE = 196
+    SAMPLE_DTYPE = np.dtype('<i2')
+
+    def __init__(self, serial_device: SerialDevice, adaptive_timeouts: bool = True):
+        self.serial_device = serial_device
+        self.samples_per_batch = self.SAMPLES_PER_BATCH
+        # Learn per-command deadlines from the measured round trips instead of fixed sleeps
+        self.adaptive_timeouts = adaptive_timeouts
+        self.command_timings = {}
+        self.serial_device.connect()
+
+    @property
+    def sample_package_size(self) -> int:
+        return self.package_size(self.samples_per_batch)
+
+    @classmethod
+    def package_size(cls, samples_per_batch: int) -> int:
+        return len(cls.SAMPLE_PACKAGE_HEADER) + samples_per_batch * 3 * cls.SAMPLE_DTYPE.itemsize
+
+    def get_command_timings(self) -> dict:
+        """
+        Returns the round trip statistics of every command sent so far.
+
         """
-        Returns a batch of samples from the device.
+        return {name: timing.stats() for name, timing in self.command_timings.items()}
+
+    def _timing(self, name: str) -> CommandTiming:
+        timing = self.command_timings.get(name)
+        if timing is None:
+            timing = self.command_timings[name] = CommandTiming()
+        return timing
+
+    def _send_command(self, command: str, timeout: int = 0.3, batch_download: bool = False,
+                      response_timeout: int = 10) -> str:
+        name = command.split(maxsplit=1)[0]
+        with registry.timer('command_duration_seconds', command=name):
+            return self._exchange(command, self._timing(name), timeout, batch_download, response_timeout)
+
+    def _exchange(self, command: str, timing: CommandTiming, timeout, batch_download: bool,
+                  response_timeout) -> str:
+        adaptive = self.adaptive_timeouts and timing.rtt_s is not None
+        # Until the first round trip is measured the fixed post-write sleep is kept,
+        # it is part of that first sample, which keeps the initial estimate conservative
+        sent_time = time.monotonic()
+        self.serial_device.send(command, 0 if adaptive else timeout)
+
+        if batch_download:
+            response = self._receive_package(timing if adaptive else None)
+            complete = len(response) == self.sample_package_size or response.startswith(b':er')
+        else:
+            # Only complete reply lines are returned
+            response = self._receive_response(response_timeout, timing if adaptive else None)
+            complete = bool(response)
+
+        # A truncated reply would shorten the learned deadline
+        if complete:
+            timing.update(time.monotonic() - sent_time)
+        return response
+
+    def _receive_package(self, timing: CommandTiming = None) -> bytes:
+        if timing is None:
+            return self.serial_device.receive_package(self.sample_package_size)
+
+        package_size = self.sample_package_size
+        response = self.serial_device.receive_package(package_size,
+                                                      timing.deadline(self.serial_device.PACKAGE_TIMEOUT_S))
+        if len(response) < package_size and not response.startswith(b':er'):
+            # Missed the learned deadline, nothing or only part of the package arrived,
+            # wait for the rest with the conservative limit
+            timing.misses += 1
+            response += self.serial_device.receive_package(package_size - len(response),
+                                                           self.serial_device.PACKAGE_TIMEOUT_S)
+        return response
+
+    def _receive_response(self, response_timeout, timing: CommandTiming = None) -> str:
+        start_time = time.monotonic()
+        deadline = start_time + response_timeout
+        poll_interval = 0.25
+        if timing is not None:
+            deadline = start_time + timing.deadline(response_timeout)
+            poll_interval = timing.poll_interval()
+
+        while True:
+            # In reader thread mode receive() itself waits for the reply line
+            response = self.serial_device.receive(max(deadline - time.monotonic(), 0))
+            if response:
+                break
+            if time.monotonic() >= deadline:
+                if timing is None:
+                    break
+                # Missed the learned deadline, fall back to the conservative limit
+                timing.misses += 1
+                timing = None
+                deadline = start_time + response_timeout
+                poll_interval = 0.25
+                continue
+            if not self.serial_device.reader_thread:
+                time.sleep(poll_interval)
+        return response
+
+    def _send_setting(self, command: str, **kwargs) -> str:
+        response = self._send_command(command, **kwargs)
+        if not response.startswith(':ok'):
+            raise Exception(f'Command {command.strip()} failed: {response}')
+        return response
+
+    def apply_settings(self, settings: dict, timeout: int = 0.3) -> list:
+        """
+        Sends several settings in a single write and collects all acknowledgements.
+        Keys are the setting commands (e.g. 'accscale'), values their arguments.
+
+        """
+        commands = [f'{name} {value}\n' for name, value in settings.items()]
+        with registry.timer('command_duration_seconds', command='settings'):
+            self.serial_device.send(''.join(commands), timeout)
+            responses = [self._receive_response(10) for _ in commands]
+
+        failed = [f'{command.strip()}: {response}' for command, response in zip(commands, responses)
+                  if not response.startswith(':ok')]
+        if failed:
+            raise Exception(f'Commands failed: {", ".join(failed)}')
+        return responses
+
+    def get_firmware_version(self):
+        '''
+        Returns the firmware version of the device.
+
+        Returns:
+            str: The firmware version of the device.
+
+        '''
+        response = self._send_setting('getfwver\n')
+        return self._parse_firmware_version(response)
+
+    def check_connection(self) -> bool:
+        try:
+            self.get_firmware_version()
+            return True
+        except Exception as e:
+            logger.error(f'Connection check failed: {e}')
+            return False
+
+    def set_batch_size(self, samples_per_batch: int):
+        """
+        Sets the number of samples the device sends per batch. The following
+        batches are requested and decoded with the new size.
+
+        """
+        response = self._send_setting(f'acqbatchsize {samples_per_batch}\n')
+        self.samples_per_batch = samples_per_batch
+        # Round trips learned with the previous package size do not apply any more
+        self.command_timings.pop('acqgetbatch', None)
+        return response
+
+    def set_baudrate(self, baudrate: int):
+        """
+        Switches the device and then the host to another baud rate. The device
+        acknowledges at the old rate. If it does not answer at the new rate, the
+        port is reopened, which returns both sides to the default rate, and an
+        exception is raised.
+
+        """
+        response = self._send_setting(f'uartbaudrate {baudrate}\n')
+        self.serial_device.set_baudrate(baudrate)
+        # Round trips are learned again at the new rate
+        self.command_timings.clear()
+        if not self.check_connection():
+            # The device stays at the new rate, only a reopen takes it back
+            self.serial_device.reopen()
+            raise Exception(f'Device not responding at {baudrate} baud, '
+                            f'port reopened at {self.serial_device.baudrate} baud.')
+        return response
+
+    @measure_time
+    def get_sample_batch(self, sample_batch_no, out: np.ndarray = None) -> np.ndarray:
+        """
+        Returns a batch of samples from the device as an int16 (samples_per_batch, 3) array.
+        If `out` is given the samples are written into it instead.
         
         """
+        response = self._send_command(self._sample_batch_command(sample_batch_no), batch_download=True)
+        samples = self._decode_sample_package(response, self.sample_package_size)
+        if out is None or not samples.size:
+            return samples
+        out[:len(samples)] = samples
+        return out[:len(samples)]
+
+    def get_sample_batches(self, sample_batch_nos, window: int = 8, out: np.ndarray = None):
+        """
+        Pipelined variant of get_sample_batch. Keeps up to `window` batch requests
+        in flight and yields the decoded batches in request order. If `out` is given,
+        batch n is written into out[n * samples_per_batch:(n + 1) * samples_per_batch].
 
-        return []
+        """
+        package_size = self.sample_package_size
+        sample_batch_nos = iter(sample_batch_nos)
+        in_flight = deque()
+
+        for sample_batch_no in sample_batch_nos:
+            self.serial_device.send(self._sample_batch_command(sample_batch_no), 0)
+            in_flight.append((sample_batch_no, time.perf_counter_ns()))
+            if len(in_flight) >= window:
+                break
+
+        try:
+            while in_flight:
+                sample_batch_no, sent_time = in_flight.popleft()
+                response = self.serial_device.receive_package(package_size)
+                registry.observe_ns('command_duration_seconds', time.perf_counter_ns() - sent_time,
+                                    command='acqgetbatch')
+
+                # Refill the window before decoding so the link never goes idle
+                next_batch_no = next(sample_batch_nos, None)
+                if next_batch_no is not None:
+                    self.serial_device.send(self._sample_batch_command(next_batch_no), 0)
+                    in_flight.append((next_batch_no, time.perf_counter_ns()))
+
+                samples = self._decode_sample_package(response, package_size)
+                if out is not None and samples.size:
+                    position = sample_batch_no * self.samples_per_batch
+                    out[position:position + len(samples)] = samples
+                    samples = out[position:position + len(samples)]
+                yield samples
+        finally:
+            # Replies to requests still in flight would be taken for the next command's reply
+            for _ in in_flight:
+                self.serial_device.receive_package(package_size)
+
+    @classmethod
+    def _sample_batch_command(cls, sample_batch_no) -> str:
+        return f'acqgetbatch {sample_batch_no}\n'
+
+    @classmethod
+    def _sample_info_command(cls) -> str:
+        return 'acqgetinfo\n'
+
+    @classmethod
+    def _decode_sample_package(cls, package: bytes, package_size: int) -> np.ndarray:
+        # Read-only view on the received bytes, no per-sample objects are created
+        if len(package) != package_size or not package.startswith(cls.SAMPLE_PACKAGE_HEADER):
+            return np.empty((0, 3), dtype=cls.SAMPLE_DTYPE)
+        return np.frombuffer(package, dtype=cls.SAMPLE_DTYPE,
+                             offset=len(cls.SAMPLE_PACKAGE_HEADER)).reshape(-1, 3)
+
+    @classmethod
+    def _parse_firmware_version(cls, response: str) -> str:
+        return response[len(':ok'):].strip()
+
+    @classmethod
+    def _parse_sample_info(cls, response: str) -> SampleInfo:
+        # ':ok <acc id> <scale> <sampling frequency> <num samples> <acquisition time ms>'
+        fields = response.split()
+        if len(fields) != 6 or fields[0] != ':ok':
+            raise Exception(f'Invalid sample info response: {response}')
+        return SampleInfo(accelerometer_id=int(fields[1]),
+                          accelerometer_scale=int(fields[2]),
+                          sampling_frequency=float(fields[3]),
+                          num_of_acq_samples=int(fields[4]),
+                          acquisition_time=int(fields[5]))
 
     def get_sample_info(self) -> namedtuple:
         '''
         Returns the sample info of the device.
 
         '''
-        return "An response"
+        response = self._send_command(self._sample_info_command())
+        return self._parse_sample_info(response)
 
     def __del__(self):
         self.serial_device.disconnect()
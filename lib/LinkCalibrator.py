@@ -0,0 +1,174 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+from lib.logging_config import logger
+from lib.DeviceProtocol import DeviceProtocol
+
+
+logger = logging.getLogger(__name__)
+
+LinkSettings = namedtuple('LinkSettings', ['baudrate',
+                                           'samples_per_batch',
+                                           'goodput_bytes_per_s',
+                                           'error_rate'])
+
+
+class LinkCalibrator:
+    """
+    Probes the link with increasing baud rates and batch sizes, measures goodput and
+    error rate of a short download and picks the fastest combination without errors.
+    The result is cached per port and device, later runs only apply it.
+
+    """
+    BAUDRATES = (230400, 460800, 921600)
+    BATCH_SIZES = (32, 64, 128, 256)
+    # Sample bytes downloaded for every probed combination
+    PROBE_BYTES = 16 * 1024
+    MAX_ERROR_RATE = 0.0
+    CACHE_FILE = 'link_calibration.json'
+    # Devices calibrated in parallel update the same cache file
+    _cache_lock = threading.Lock()
+
+    def __init__(self, protocol: DeviceProtocol, cache_file: str = CACHE_FILE, window: int = 1):
+        self.protocol = protocol
+        self.cache_file = cache_file
+        # Batch requests kept in flight while probing, like the download that follows
+        self.window = window
+
+    def device_key(self) -> str:
+        # The firmware version is the only identification the device reports
+        return f'{self.protocol.serial_device.port} {self.protocol.get_firmware_version()}'
+
+    def _read_cache(self) -> dict:
+        if not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file) as cache:
+                return json.load(cache)
+        except (OSError, ValueError) as e:
+            logger.warning(f'Ignoring link calibration cache {self.cache_file}: {e}')
+            return {}
+
+    def _write_cache(self, key: str, settings: LinkSettings):
+        with self._cache_lock:
+            cache = self._read_cache()
+            if settings is None:
+                cache.pop(key, None)
+            else:
+                cache[key] = settings._asdict()
+            # Replaced at once, a reader never sees a partly written file
+            temp_file = f'{self.cache_file}.{os.getpid()}.tmp'
+            with open(temp_file, 'w') as out:
+                json.dump(cache, out, indent=2)
+            os.replace(temp_file, self.cache_file)
+
+    def apply(self, settings: LinkSettings):
+        if settings.baudrate != self.protocol.serial_device.baudrate:
+            self.protocol.set_baudrate(settings.baudrate)
+        if settings.samples_per_batch != self.protocol.samples_per_batch:
+            self.protocol.set_batch_size(settings.samples_per_batch)
+
+    def probe(self, num_samples: int) -> tuple:
+        """
+        Downloads about PROBE_BYTES of the acquired samples with the current link
+        settings and returns (goodput in bytes/s, error rate). Batches are downloaded
+        again if the capture is shorter than that.
+
+        """
+        samples_per_batch = self.protocol.samples_per_batch
+        batch_bytes = samples_per_batch * 3 * self.protocol.SAMPLE_DTYPE.itemsize
+        available = max(-(-num_samples // samples_per_batch), 1)
+        num_batches = max(self.PROBE_BYTES // batch_bytes, 1)
+
+        batches = 0
+        errors = 0
+        start_time = time.perf_counter()
+        sample_buffers = self.protocol.get_sample_batches([n % available for n in range(num_batches)],
+                                                          self.window)
+        try:
+            for sample_buffer in sample_buffers:
+                batches += 1
+                if len(sample_buffer) != samples_per_batch:
+                    # The rest of the stream is not aligned to the packages any more
+                    errors += 1
+                    break
+        finally:
+            sample_buffers.close()
+        elapsed_s = time.perf_counter() - start_time
+        if errors:
+            # Late packages would be taken for the replies to the next commands
+            serial_device = self.protocol.serial_device
+            serial_device.reset_input(serial_device.PACKAGE_TIMEOUT_S)
+
+        goodput = (batches - errors) * batch_bytes / elapsed_s if elapsed_s else 0.0
+        return goodput, errors / batches
+
+    def calibrate(self, num_samples: int) -> LinkSettings:
+        """
+        Probes every combination of baud rate and batch size, starting from the
+        current baud rate, applies the best stable one and returns it. A baud rate
+        is not raised further once its smallest batch size is not stable, or once
+        the device does not answer at it, the port is then back at the default rate.
+
+        """
+        serial_device = self.protocol.serial_device
+        default = LinkSettings(serial_device.baudrate, self.protocol.SAMPLES_PER_BATCH, 0.0, None)
+        results = []
+
+        for baudrate in (baudrate for baudrate in self.BAUDRATES if baudrate >= default.baudrate):
+            if baudrate != serial_device.baudrate:
+                try:
+                    self.protocol.set_baudrate(baudrate)
+                except Exception as e:
+                    logger.info(f'Baud rate {baudrate} not available: {e}')
+                    break
+
+            stable = False
+            for samples_per_batch in self.BATCH_SIZES:
+                try:
+                    self.protocol.set_batch_size(samples_per_batch)
+                except Exception as e:
+                    logger.info(f'Batch size {samples_per_batch} not available: {e}')
+                    break
+                goodput, error_rate = self.probe(num_samples)
+                logger.info(f'Link probe {baudrate} baud, {samples_per_batch} samples per batch: '
+                            f'{goodput:.0f} B/s, error rate {error_rate:.3f}')
+                results.append(LinkSettings(baudrate, samples_per_batch, goodput, error_rate))
+                if error_rate > self.MAX_ERROR_RATE:
+                    break
+                stable = True
+            if not stable:
+                break
+
+        stable_results = [result for result in results if result.error_rate <= self.MAX_ERROR_RATE]
+        best = max(stable_results, key=lambda result: result.goodput_bytes_per_s, default=default)
+        self.apply(best)
+        logger.info(f'Link calibrated: {best.baudrate} baud, {best.samples_per_batch} samples per batch.')
+        return best
+
+    def run(self, num_samples: int, force: bool = False) -> LinkSettings:
+        """
+        Applies the cached link settings of the device, or calibrates the link if
+        there are none (or `force` is set) and caches the result.
+
+        """
+        key = self.device_key()
+        cached = self._read_cache().get(key)
+        if cached is not None and not force:
+            settings = LinkSettings(**cached)
+            try:
+                self.apply(settings)
+                logger.info(f'Using cached link settings: {settings.baudrate} baud, '
+                            f'{settings.samples_per_batch} samples per batch.')
+                return settings
+            except Exception as e:
+                logger.warning(f'Cached link settings failed, calibrating again: {e}')
+                self._write_cache(key, None)
+
+        settings = self.calibrate(num_samples)
+        self._write_cache(key, settings)
+        return settings
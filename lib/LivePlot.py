@@ -0,0 +1,94 @@
+import time
+import tkinter as tk
+
+import numpy as np
+from scipy.fft import rfft
+
+
+def minmax_decimate(values: np.ndarray, width: int):
+    """
+    Reduces the (N, channels) values to the min and max of every one of `width`
+    columns, so peaks stay visible however many samples fall on one pixel.
+
+    Returns:
+        tuple: column start indices, (columns, channels) minima and maxima.
+
+    """
+    num_values = len(values)
+    columns = min(width, num_values)
+    starts = np.arange(columns) * num_values // columns
+    return starts, np.minimum.reduceat(values, starts, axis=0), np.maximum.reduceat(values, starts, axis=0)
+
+
+class LivePlot:
+    """
+    Waveform and spectrum view of the x/y/z samples drawn on Tk canvases.
+    Every axis is drawn as one polyline through the per-pixel min/max values.
+
+    """
+    AXIS_COLORS = ('red', 'green', 'blue')
+    # The spectrum of a growing capture is recalculated at most this often
+    SPECTRUM_INTERVAL_S = 0.5
+
+    def __init__(self, parent, width: int = 500, height: int = 160):
+        self.width = width
+        self.height = height
+        self.frame = tk.Frame(parent)
+        self.waveform = tk.Canvas(self.frame, width=width, height=height, background='white')
+        self.spectrum = tk.Canvas(self.frame, width=width, height=height, background='white')
+        self.waveform.grid(row=0, column=0, padx=5, pady=5)
+        self.spectrum.grid(row=1, column=0, padx=5, pady=5)
+
+        self.waveform_lines = [self.waveform.create_line(0, 0, 0, 0, fill=color) for color in self.AXIS_COLORS]
+        self.spectrum_lines = [self.spectrum.create_line(0, 0, 0, 0, fill=color) for color in self.AXIS_COLORS]
+        self.spectrum_label = self.spectrum.create_text(5, 5, anchor='nw', text='')
+        self.spectrum_time = 0.0
+
+    def grid(self, **kwargs):
+        self.frame.grid(**kwargs)
+
+    def clear(self):
+        for line in self.waveform_lines:
+            self.waveform.coords(line, 0, 0, 0, 0)
+        for line in self.spectrum_lines:
+            self.spectrum.coords(line, 0, 0, 0, 0)
+        self.spectrum.itemconfig(self.spectrum_label, text='')
+        self.spectrum_time = 0.0
+
+    def update(self, samples: np.ndarray, sampling_frequency: float, complete: bool = False):
+        if len(samples) < 2:
+            return
+        self._draw_minmax(self.waveform, self.waveform_lines, samples)
+
+        now = time.monotonic()
+        if complete or now - self.spectrum_time >= self.SPECTRUM_INTERVAL_S:
+            self.spectrum_time = now
+            self._draw_spectrum(samples, sampling_frequency)
+
+    def _draw_spectrum(self, samples: np.ndarray, sampling_frequency: float):
+        centered = samples - samples.mean(axis=0)
+        amplitude = np.abs(rfft(centered, axis=0, workers=-1))
+        amplitude_db = 20 * np.log10(amplitude + 1e-9)
+        self._draw_minmax(self.spectrum, self.spectrum_lines, amplitude_db)
+        self.spectrum.itemconfig(self.spectrum_label, text=f'0 - {sampling_frequency / 2:.0f} Hz')
+
+    def _draw_minmax(self, canvas, lines, values: np.ndarray):
+        num_values = len(values)
+        starts, minima, maxima = minmax_decimate(values, self.width)
+        minima = minima.astype(np.float64)
+        maxima = maxima.astype(np.float64)
+
+        low, high = minima.min(), maxima.max()
+        y_scale = (self.height - 4) / (high - low) if high > low else 0.0
+        x = starts * (self.width - 1) / max(num_values - 1, 1)
+
+        for axis, line in enumerate(lines):
+            # Two vertices per column: from the column minimum to its maximum
+            y_min = self.height - 2 - (minima[:, axis] - low) * y_scale
+            y_max = self.height - 2 - (maxima[:, axis] - low) * y_scale
+            points = np.empty((len(x) * 2, 2))
+            points[0::2, 0] = x
+            points[1::2, 0] = x
+            points[0::2, 1] = y_min
+            points[1::2, 1] = y_max
+            canvas.coords(line, *points.ravel().tolist())
@@ -0,0 +1,99 @@
+import logging
+import re
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from lib.logging_config import logger
+from lib.AccTestApp import AccTestApp
+
+
+logger = logging.getLogger(__name__)
+
+DeviceRecord = namedtuple('DeviceRecord', ['port',
+                                           'sample_info',
+                                           'filename',
+                                           'acquisition_time_s',
+                                           'download_time_s',
+                                           'save_time_s'])
+
+LoopRecord = namedtuple('LoopRecord', ['iteration', 'wall_time_s', 'devices'])
+
+
+class MultiAccTestApp:
+    """
+    Runs the same acquisition on several devices, one serial port each.
+    Every device is driven from its own worker thread, so the wall time of a
+    loop iteration is set by the slowest device.
+
+    """
+    def __init__(self, param_dict):
+        logger.info('Starting Multi Device Test App...')
+        self.ports = list(param_dict['port'])
+        self.loop_times = param_dict['looptimes']
+
+        self.apps = [AccTestApp({**param_dict, 'port': port}, file_prefix=self._file_prefix(port))
+                     for port in self.ports]
+        self.executor = ThreadPoolExecutor(max_workers=len(self.apps), thread_name_prefix='AccDevice')
+        self.records = []
+
+    @staticmethod
+    def _file_prefix(port: str) -> str:
+        # Captures of the same accelerometer id on different ports must not collide
+        return re.sub(r'\W+', '_', port).strip('_') + '_'
+
+    def _map(self, func):
+        """
+        Calls func(app) for every device in parallel and returns the results in port order.
+        Exceptions from any device are re-raised after all devices finished.
+
+        """
+        futures = [self.executor.submit(func, app) for app in self.apps]
+        # A failing device must not leave the others running into the next call
+        wait(futures)
+        return [future.result() for future in futures]
+
+    def init(self):
+        self._map(lambda app: app.init())
+
+    def run(self) -> list:
+        for iteration in range(self.loop_times):
+            start_barrier = threading.Barrier(len(self.apps))
+
+            def run_device(app):
+                # All devices are triggered at the same moment
+                start_barrier.wait()
+                start_time = time.perf_counter()
+                app.acquire()
+                acquired_time = time.perf_counter()
+                if app.stream:
+                    # Saved while downloading, the download time includes saving
+                    filename = app.download_and_stream()
+                    sample_info = app.sample_info
+                    downloaded_time = saved_time = time.perf_counter()
+                else:
+                    sample_info, acc_data = app.download()
+                    downloaded_time = time.perf_counter()
+                    filename = app.save(sample_info, acc_data)
+                    saved_time = time.perf_counter()
+                return DeviceRecord(port=app.device.port,
+                                    sample_info=sample_info,
+                                    filename=filename,
+                                    acquisition_time_s=acquired_time - start_time,
+                                    download_time_s=downloaded_time - acquired_time,
+                                    save_time_s=saved_time - downloaded_time)
+
+            start_time = time.perf_counter()
+            devices = self._map(run_device)
+            record = LoopRecord(iteration=iteration,
+                                wall_time_s=time.perf_counter() - start_time,
+                                devices=devices)
+            self.records.append(record)
+            logger.info(f'Iteration {iteration} finished on {len(devices)} devices in {record.wall_time_s:.3f}s.')
+
+        return self.records
+
+    def __del__(self):
+        self.executor.shutdown(wait=False)
+        logger.info('Multi Device Test App finished.')
@@ -1,25 +1,52 @@
 import serial
 import logging
+import threading
 import time
 import struct
 
-from lib.logging_config import logger
+from lib.logging_config import logger, trace_wire
+from lib.metrics import registry
 
 
 logger = logging.getLogger(__name__)
 
 
 class SerialDevice:
+    # Used only in reader thread mode
+    READER_POLL_S = 0.05
+    RECEIVE_TIMEOUT_S = 10
+    PACKAGE_TIMEOUT_S = 1
+    # Margin on the wire time of a package, the default package wait in polling mode
+    PACKAGE_POLL_MARGIN_S = 0.05
 
-    def __init__(self, port:str, baudrate:int, timeout:int=0):
+    def __init__(self, port:str, baudrate:int, timeout:int=0, reader_thread:bool=False):
         self.port = port
         self.baudrate = baudrate
+        # The device returns to this rate whenever the port is reopened
+        self.default_baudrate = baudrate
         self.timeout = timeout
         self.connection = None
+        # Start of a reply line not yet completely received in polling mode
+        self._partial_line = b''
+
+        self.reader_thread = reader_thread
+        self._reader = None
+        self._reader_stop = threading.Event()
+        self._rx_buffer = bytearray()
+        self._rx_ready = threading.Condition()
+
+    @property
+    def is_connected(self) -> bool:
+        return self.connection is not None and self.connection.is_open
 
     def connect(self):
         try:
-            self.connection = serial.Serial(self.port, self.baudrate, timeout=self.timeout)
+            if self.reader_thread:
+                # The reader blocks in read() until data arrives instead of polling
+                self.connection = serial.Serial(self.port, self.baudrate, timeout=self.READER_POLL_S)
+                self._start_reader()
+            else:
+                self.connection = serial.Serial(self.port, self.baudrate, timeout=self.timeout)
             logger.debug(f'Connected to {self.port}')
 
         except serial.SerialException as e:
@@ -27,44 +54,192 @@ class SerialDevice:
 
 
     def disconnect(self):
+        self._stop_reader()
         if self.connection and self.connection.is_open:
             self.connection.close()
             logger.debug(f'Disconnected from {self.port}')
 
 
+    def reopen(self):
+        """
+        Closes the port and opens it again at the default baud rate, the device
+        returns to that rate too.
+
+        """
+        self.disconnect()
+        self.baudrate = self.default_baudrate
+        self._partial_line = b''
+        self.connect()
+
+
     def send(self, message:str, timeout):
         if not self.connection or not self.connection.is_open:
             logger.error('Attempt to send while serial port not connected.')
             raise Exception('Serial port not connected.')
-        self.connection.write(message.encode())
-        logger.debug(f'Sent: {message.strip()}')
-        time.sleep(timeout)
+        data = message.encode()
+        self.connection.write(data)
+        registry.inc('serial_bytes_sent_total', len(data), port=self.port)
+        trace_wire(self.port, 'tx', data)
+        logger.debug('Sent: %s', message.strip())
+        if not self.reader_thread:
+            time.sleep(timeout)
 
-    def receive(self):
+    def receive(self, timeout=None):
         if not self.connection or not self.connection.is_open:
             logger.error('Attempt to send while serial port not connected.')
             raise Exception('Serial port not connected.')
-        response = self.connection.readline().decode().strip()
-        logger.debug(f'Received: {response}\n')
+        if self.reader_thread:
+            # Like in polling mode, the start of a line not complete in time stays buffered
+            line = self._wait_for_frame(self._take_line, self.RECEIVE_TIMEOUT_S if timeout is None else timeout,
+                                        keep_partial=True)
+        else:
+            line = self._partial_line + self.connection.readline()
+            self._partial_line = b''
+            if line and not line.endswith(b'\n'):
+                # The rest of the line is still on the wire
+                self._partial_line = line
+                return ''
+        registry.inc('serial_bytes_received_total', len(line), port=self.port)
+        trace_wire(self.port, 'rx', line)
+        response = line.decode().strip()
+        logger.debug('Received: %s\n', response)
         return response
     
-    def receive_package(self):
+    def package_wire_time(self, package_size: int) -> float:
+        # 8N1 framing, 10 bits on the wire per byte
+        return package_size * 10 / self.baudrate
+
+    def receive_package(self, package_size:int, timeout=None):
         if not self.connection or not self.connection.is_open:
             logger.error('Attempt to send while serial port not connected.')
             raise Exception('Serial port not connected.')
 
-        for i in range(500):
-            if self.connection.in_waiting >= 196:
-                break
-            time.sleep(0.0001)
-
-        response = self.connection.read_all()       
-        messages = response.split(b'\n')
-        if messages == b':er':
-            logger.error(f'Received: {messages[0]}')
-        elif not messages :
-            logger.error(f'Received: {response}')
+        if self.reader_thread:
+            response = self._wait_for_frame(lambda: self._take_package(package_size),
+                                            self.PACKAGE_TIMEOUT_S if timeout is None else timeout)
+        else:
+            if timeout is None:
+                # Negotiated batch sizes make packages take longer than one poll on the wire
+                timeout = self.package_wire_time(package_size) + self.PACKAGE_POLL_MARGIN_S
+            deadline = time.monotonic() + timeout
+            while self.connection.in_waiting < package_size and time.monotonic() < deadline:
+                time.sleep(0.0001)
+
+            # Read only one package, the next ones may already be on the wire
+            # when batch requests are pipelined.
+            response = self.connection.read(min(self.connection.in_waiting, package_size))
+        registry.inc('serial_bytes_received_total', len(response), port=self.port)
+        trace_wire(self.port, 'rx', response)
+        if response.startswith(b':er'):
+            logger.error('Received: %s', response.strip())
+        elif not response:
+            logger.error('Received: %s', response)
         else:
-            logger.debug(f'Received: {messages[0]} + data(not writed here)\n')
+            logger.debug('Received: %s + data(not writed here)\n', response[:len(b':ok')])
     
-        return response
\ No newline at end of file
+        return response
+
+    def set_baudrate(self, baudrate: int):
+        """
+        Changes the baud rate of the open connection and discards pending input.
+
+        """
+        self.baudrate = baudrate
+        if self.connection and self.connection.is_open:
+            self.connection.baudrate = baudrate
+        self.reset_input()
+        logger.debug(f'Baud rate of {self.port} set to {baudrate}')
+
+    def reset_input(self, settle_s: float = 0):
+        """
+        Discards everything received but not read yet. With `settle_s` it waits
+        until nothing more has been received for that long, so a late reply to an
+        abandoned request is discarded too instead of being taken for the next one.
+
+        """
+        if self.reader_thread:
+            with self._rx_ready:
+                self._rx_buffer.clear()
+                # The reader notifies for every chunk it receives
+                while settle_s and self._rx_ready.wait(settle_s):
+                    self._rx_buffer.clear()
+        elif self.connection and self.connection.is_open:
+            self.connection.reset_input_buffer()
+            deadline = time.monotonic() + settle_s
+            while time.monotonic() < deadline:
+                if self.connection.in_waiting:
+                    self.connection.reset_input_buffer()
+                    deadline = time.monotonic() + settle_s
+                time.sleep(0.001)
+        self._partial_line = b''
+
+    def _start_reader(self):
+        self._reader_stop.clear()
+        with self._rx_ready:
+            self._rx_buffer.clear()
+        self._reader = threading.Thread(target=self._read_loop, name=f'SerialReader-{self.port}', daemon=True)
+        self._reader.start()
+
+    def _stop_reader(self):
+        if self._reader is None:
+            return
+        self._reader_stop.set()
+        self._reader.join()
+        self._reader = None
+
+    def _read_loop(self):
+        """
+        Drains the port into the receive buffer and wakes the waiting callers.
+
+        """
+        while not self._reader_stop.is_set():
+            try:
+                data = self.connection.read(max(1, self.connection.in_waiting))
+            except serial.SerialException as e:
+                logger.error(f'Error reading from {self.port}: {e}')
+                break
+            if data:
+                with self._rx_ready:
+                    self._rx_buffer += data
+                    self._rx_ready.notify_all()
+
+    def _wait_for_frame(self, take_frame, timeout, keep_partial: bool = False) -> bytes:
+        """
+        Waits until take_frame can split a frame off the receive buffer.
+        Returns whatever is buffered if the timeout expires first, or with
+        `keep_partial` nothing, the buffer is then left for the next call.
+
+        """
+        deadline = time.monotonic() + timeout
+        with self._rx_ready:
+            frame = take_frame()
+            while frame is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    if keep_partial:
+                        return b''
+                    frame = bytes(self._rx_buffer)
+                    self._rx_buffer.clear()
+                    break
+                self._rx_ready.wait(remaining)
+                frame = take_frame()
+        return frame
+
+    def _take_line(self):
+        end = self._rx_buffer.find(b'\n')
+        if end < 0:
+            return None
+        return self._take(end + 1)
+
+    def _take_package(self, package_size):
+        # An error reply is a short text line instead of a full package
+        if self._rx_buffer.startswith(b':er'):
+            return self._take_line()
+        if len(self._rx_buffer) < package_size:
+            return None
+        return self._take(package_size)
+
+    def _take(self, size) -> bytes:
+        frame = bytes(self._rx_buffer[:size])
+        del self._rx_buffer[:size]
+        return frame
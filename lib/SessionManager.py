@@ -0,0 +1,51 @@
+import logging
+
+from lib.logging_config import logger
+from lib.AccTestApp import AccTestApp
+
+
+logger = logging.getLogger(__name__)
+
+
+class SessionManager:
+    """
+    Keeps one open connection per serial port across runs. A session is reused
+    as long as its connection parameters do not change and the port is still
+    open, other parameters are applied to the already initialized controller.
+
+    """
+    CONNECTION_PARAMS = ('port', 'baudrate', 'readerthread')
+
+    def __init__(self):
+        # port -> (connection params, AccTestApp)
+        self.sessions = {}
+
+    def get_app(self, param_dict) -> tuple:
+        """
+        Returns the AccTestApp of the port and whether a new connection was opened.
+
+        """
+        port = param_dict['port']
+        connection_params = tuple(param_dict[name] for name in self.CONNECTION_PARAMS)
+
+        session = self.sessions.get(port)
+        # A port which failed to open is opened again on every run
+        if session is not None and session[0] == connection_params and session[1].device.is_connected:
+            app = session[1]
+            app.update_params(param_dict)
+            return app, False
+
+        self.close(port)
+        app = AccTestApp(param_dict)
+        self.sessions[port] = (connection_params, app)
+        return app, True
+
+    def close(self, port):
+        session = self.sessions.pop(port, None)
+        if session is not None:
+            session[1].device.disconnect()
+            logger.info(f'Session on {port} closed.')
+
+    def close_all(self):
+        for port in list(self.sessions):
+            self.close(port)
@@ -1,33 +1,96 @@
+import atexit
+import itertools
 import logging
-import colorlog
+import queue
+from logging.handlers import QueueHandler, QueueListener
 
 file_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-console_formatter = colorlog.ColoredFormatter(
-    '%(log_color)s%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    log_colors={
-        'DEBUG': 'cyan',
-        'INFO': 'green',
-        'WARNING': 'yellow',
-        'ERROR': 'red',
-        'CRITICAL': 'bold_red',
-    }
-)
-
-# Handlery
-file_handler = logging.FileHandler('debug.log', encoding='utf-8')
-file_handler.setFormatter(file_formatter)
-
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(console_formatter)
-
-# Logger
-logging.basicConfig(
-    level=logging.DEBUG,
-    handlers=[file_handler, console_handler]
-)
 
-logger = logging.getLogger(__name__)
+# Packet-level trace of the serial traffic, see trace_wire
+wire_logger = logging.getLogger('wire')
+
+_listener = None
+_wire_trace_every = 0
+_wire_trace_counter = itertools.count()
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """
+    Puts records on the queue without formatting them, the message is built in
+    the listener thread. Log arguments must not be mutated after the call.
+
+    """
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level=logging.DEBUG, log_file: str = 'debug.log', wire_trace_every: int = 0):
+    """
+    Configures the root logger. Records are handed to a queue and written to
+    the log file and the console by a background listener thread. Nothing is
+    configured at import time, entry points call this after parsing arguments.
+
+    Args:
+        level: Root logger level.
+        log_file: Log file name, no file is written if empty.
+        wire_trace_every: Log every n-th serial packet to the 'wire' logger, 0 disables it.
+
+    """
+    global _listener, _wire_trace_every
+
+    if _listener is not None:
+        _listener.stop()
+
+    handlers = []
+    if log_file:
+        file_handler = logging.FileHandler(log_file, encoding='utf-8')
+        file_handler.setFormatter(file_formatter)
+        handlers.append(file_handler)
 
+    import colorlog
 
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(colorlog.ColoredFormatter(
+        '%(log_color)s%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        log_colors={
+            'DEBUG': 'cyan',
+            'INFO': 'green',
+            'WARNING': 'yellow',
+            'ERROR': 'red',
+            'CRITICAL': 'bold_red',
+        }
+    ))
+    handlers.append(console_handler)
 
+    log_queue = queue.SimpleQueue()
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
 
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(_DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+
+    _wire_trace_every = wire_trace_every
+    wire_logger.setLevel(logging.DEBUG if wire_trace_every else logging.NOTSET)
+
+
+def trace_wire(port: str, direction: str, data: bytes):
+    """
+    Logs a sampled hex dump of serial traffic when wire tracing is enabled.
+
+    """
+    if _wire_trace_every and next(_wire_trace_counter) % _wire_trace_every == 0:
+        wire_logger.debug('%s %s %d bytes: %s', port, direction, len(data), data.hex(' '))
+
+
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+
+atexit.register(_stop_listener)
+
+logger = logging.getLogger(__name__)
@@ -0,0 +1,153 @@
+import bisect
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Latency histogram bucket upper bounds in ns: 1 us to ~1000 s, sqrt(2) apart
+BUCKET_BOUNDS_NS = [int(1000 * math.sqrt(2) ** i) for i in range(61)]
+
+
+class Histogram:
+    """
+    Log-bucketed latency histogram. Quantiles are interpolated inside the bucket,
+    so they are accurate to about the bucket width (~41%) at worst.
+
+    """
+    def __init__(self):
+        self.bucket_counts = [0] * (len(BUCKET_BOUNDS_NS) + 1)
+        self.count = 0
+        self.sum_ns = 0
+        self.min_ns = None
+        self.max_ns = None
+
+    def observe(self, value_ns: int):
+        self.bucket_counts[bisect.bisect_left(BUCKET_BOUNDS_NS, value_ns)] += 1
+        self.count += 1
+        self.sum_ns += value_ns
+        self.min_ns = value_ns if self.min_ns is None else min(self.min_ns, value_ns)
+        self.max_ns = value_ns if self.max_ns is None else max(self.max_ns, value_ns)
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.bucket_counts):
+            if seen + bucket_count >= rank and bucket_count:
+                low = BUCKET_BOUNDS_NS[i - 1] if i else 0
+                high = BUCKET_BOUNDS_NS[i] if i < len(BUCKET_BOUNDS_NS) else self.max_ns
+                value = low + (high - low) * (rank - seen) / bucket_count
+                return min(max(value, self.min_ns), self.max_ns)
+            seen += bucket_count
+        return float(self.max_ns)
+
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'sum_s': self.sum_ns / 1e9,
+            'min_s': (self.min_ns or 0) / 1e9,
+            'max_s': (self.max_ns or 0) / 1e9,
+            'p50_s': self.quantile(0.5) / 1e9,
+            'p90_s': self.quantile(0.9) / 1e9,
+            'p99_s': self.quantile(0.99) / 1e9,
+        }
+
+
+class MetricsRegistry:
+    """
+    Thread-safe registry of counters and latency histograms. Metrics are identified
+    by a Prometheus style name and optional labels.
+
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: int = 1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe_ns(self, name: str, value_ns: int, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value_ns)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start_time = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.observe_ns(name, time.perf_counter_ns() - start_time, **labels)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self._counters.items())],
+                'histograms': [{'name': name, 'labels': dict(labels), **histogram.summary()}
+                               for (name, labels), histogram in sorted(self._histograms.items())],
+            }
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self) -> str:
+        """
+        Returns the metrics in the Prometheus text exposition format, histograms in seconds.
+
+        """
+        def format_labels(labels, extra=()):
+            pairs = [f'{k}="{v}"' for k, v in (*labels, *extra)]
+            return '{' + ','.join(pairs) + '}' if pairs else ''
+
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in typed:
+                    lines.append(f'# TYPE {name} counter')
+                    typed.add(name)
+                lines.append(f'{name}{format_labels(labels)} {value}')
+
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                if name not in typed:
+                    lines.append(f'# TYPE {name} histogram')
+                    typed.add(name)
+                cumulative = 0
+                for bound_ns, bucket_count in zip(BUCKET_BOUNDS_NS, histogram.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{format_labels(labels, [("le", f"{bound_ns / 1e9:.9g}")])} {cumulative}')
+                lines.append(f'{name}_bucket{format_labels(labels, [("le", "+Inf")])} {histogram.count}')
+                lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum_ns / 1e9:.9g}')
+                lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, filename: str):
+        """
+        Writes the metrics to a file, Prometheus text format for *.prom files and JSON otherwise.
+
+        """
+        content = self.to_prometheus() if filename.endswith('.prom') else self.to_json()
+        with open(filename, 'w') as out:
+            out.write(content)
+
+
+registry = MetricsRegistry()
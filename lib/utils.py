@@ -1,17 +1,22 @@
 import time
 import logging
+import functools
 
 from lib.logging_config import logger
+from lib.metrics import registry
 
 
 logger = logging.getLogger(__name__)
 
 def measure_time(func):
+    @functools.wraps(func)
     def wrapper( *args, **kwargs):
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        elapsed_time = time.time() - start_time
-        logger.debug(f"Function '{func.__name__}' executed in {elapsed_time:.4f}s.\n")
-        return result
+        start_time = time.perf_counter_ns()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed_ns = time.perf_counter_ns() - start_time
+            registry.observe_ns('function_duration_seconds', elapsed_ns, function=func.__qualname__)
+            logger.debug("Function '%s' executed in %.4fs.", func.__name__, elapsed_ns / 1e9)
     
     return wrapper
@@ -0,0 +1,163 @@
+import logging
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+from lib.logging_config import logger
+
+
+logger = logging.getLogger(__name__)
+
+# Full scale range in g for the accelerometer_scale codes of sample_info
+SCALE_RANGES_G = {0: 2.0, 1: 4.0, 2: 8.0, 3: 16.0}
+STANDARD_GRAVITY = 9.80665
+
+RMS_VELOCITY_FREQ_LOW_HZ = 0.1
+RMS_VELOCITY_FREQ_HIGH_HZ = 1000.0
+
+# Band edges of the band energies of calculate_capture_features
+BAND_EDGES_HZ = (0.0, 10.0, 100.0, 1000.0, float('inf'))
+
+VibrationMetrics = namedtuple('VibrationMetrics', ['rms_velocity',
+                                                   'rms',
+                                                   'peak',
+                                                   'crest_factor',
+                                                   'frequencies',
+                                                   'spectrum'])
+
+CaptureFeatures = namedtuple('CaptureFeatures', ['mean',
+                                                 'rms',
+                                                 'peak',
+                                                 'crest_factor',
+                                                 'kurtosis',
+                                                 'band_energy'])
+
+
+@lru_cache(maxsize=16)
+def _hann_window(num_samples: int) -> np.ndarray:
+    window = np.hanning(num_samples)[:, np.newaxis]
+    window.setflags(write=False)
+    return window
+
+
+@lru_cache(maxsize=16)
+def _velocity_weights(num_samples: int, sampling_frequency: float, freq_low: float, freq_high: float):
+    """
+    Per-bin weights turning the squared acceleration spectrum (m/s^2) into the
+    mean square velocity (mm/s) inside [freq_low, freq_high]. Includes the one-sided
+    spectrum factor and the Hann window power correction.
+
+    """
+    frequencies = np.fft.rfftfreq(num_samples, d=1.0 / sampling_frequency)
+    window_power = np.mean(_hann_window(num_samples) ** 2)
+
+    in_band = (frequencies >= freq_low) & (frequencies <= freq_high) & (frequencies > 0)
+    weights = np.zeros_like(frequencies)
+    weights[in_band] = (1000.0 / (2 * np.pi * frequencies[in_band])) ** 2
+    weights[in_band] *= 2.0 / (num_samples ** 2 * window_power)
+    if num_samples % 2 == 0 and in_band[-1]:
+        # The Nyquist bin has no mirrored negative frequency
+        weights[-1] /= 2.0
+
+    frequencies.setflags(write=False)
+    weights.setflags(write=False)
+    return frequencies, weights[:, np.newaxis]
+
+
+def calculate_vibration_metrics(sample_info: namedtuple, acc_data: np.ndarray,
+                                freq_low: float = RMS_VELOCITY_FREQ_LOW_HZ,
+                                freq_high: float = RMS_VELOCITY_FREQ_HIGH_HZ) -> VibrationMetrics:
+    """
+    Calculates per-axis vibration metrics of an (N, 3) int16 x/y/z capture.
+
+    Returns:
+        VibrationMetrics: band-limited RMS velocity [mm/s], RMS, peak and crest
+        factor of the acceleration [g], and the amplitude spectrum [g] of all axes
+        with its frequencies [Hz].
+
+    """
+    # scipy is only loaded when metrics are calculated, it dominates the start-up time
+    from scipy.fft import rfft
+
+    range_g = SCALE_RANGES_G.get(sample_info.accelerometer_scale)
+    if range_g is None:
+        raise Exception(f'Unknown accelerometer scale: {sample_info.accelerometer_scale}')
+
+    num_samples = len(acc_data)
+    if num_samples < 2:
+        raise Exception('Not enough samples to calculate vibration metrics.')
+
+    acceleration_g = np.asarray(acc_data, dtype=np.float64) * (range_g / 32768.0)
+    acceleration_g -= acceleration_g.mean(axis=0)
+
+    rms = np.sqrt(np.mean(acceleration_g ** 2, axis=0))
+    peak = np.max(np.abs(acceleration_g), axis=0)
+    crest_factor = np.divide(peak, rms, out=np.zeros_like(peak), where=rms > 0)
+
+    window = _hann_window(num_samples)
+    spectrum = np.abs(rfft(acceleration_g * window, axis=0, workers=-1))
+
+    frequencies, weights = _velocity_weights(num_samples, float(sample_info.sampling_frequency),
+                                             freq_low, freq_high)
+    rms_velocity = np.sqrt(np.sum((spectrum * STANDARD_GRAVITY) ** 2 * weights, axis=0))
+
+    # Amplitude spectrum corrected for the window's coherent gain
+    spectrum *= 2.0 / window.sum()
+
+    return VibrationMetrics(rms_velocity=rms_velocity,
+                            rms=rms,
+                            peak=peak,
+                            crest_factor=crest_factor,
+                            frequencies=frequencies,
+                            spectrum=spectrum)
+
+
+def calculate_capture_features(sample_info: namedtuple, acc_data: np.ndarray,
+                               band_edges_hz: tuple = BAND_EDGES_HZ) -> CaptureFeatures:
+    """
+    Calculates per-axis statistics of an (N, 3) int16 x/y/z capture for batch analysis.
+    Uses numpy only, so it runs single-threaded inside a worker process.
+
+    Returns:
+        CaptureFeatures: mean [g], and of the mean-free acceleration the RMS and
+        peak [g], crest factor, kurtosis (3 for a normal distribution) and the mean
+        square [g^2] in every band between consecutive band_edges_hz, shape (bands, 3).
+        All bands together add up to the squared RMS.
+
+    """
+    range_g = SCALE_RANGES_G.get(sample_info.accelerometer_scale)
+    if range_g is None:
+        raise Exception(f'Unknown accelerometer scale: {sample_info.accelerometer_scale}')
+
+    num_samples = len(acc_data)
+    if num_samples < 2:
+        raise Exception('Not enough samples to calculate capture features.')
+
+    acceleration_g = np.asarray(acc_data, dtype=np.float64) * (range_g / 32768.0)
+    mean = acceleration_g.mean(axis=0)
+    acceleration_g -= mean
+
+    mean_square = np.mean(acceleration_g ** 2, axis=0)
+    rms = np.sqrt(mean_square)
+    peak = np.max(np.abs(acceleration_g), axis=0)
+    crest_factor = np.divide(peak, rms, out=np.zeros_like(peak), where=rms > 0)
+    kurtosis = np.divide(np.mean(acceleration_g ** 4, axis=0), mean_square ** 2,
+                         out=np.zeros_like(mean_square), where=mean_square > 0)
+
+    # One-sided power spectrum, by Parseval it sums up to the mean square
+    power = np.abs(np.fft.rfft(acceleration_g, axis=0)) ** 2 * (2.0 / num_samples ** 2)
+    power[0] /= 2.0
+    if num_samples % 2 == 0:
+        power[-1] /= 2.0
+    frequencies = np.fft.rfftfreq(num_samples, d=1.0 / sample_info.sampling_frequency)
+    cumulative = np.concatenate([np.zeros((1, 3)), np.cumsum(power, axis=0)])
+    edges = np.searchsorted(frequencies, band_edges_hz, side='left')
+    band_energy = cumulative[edges[1:]] - cumulative[edges[:-1]]
+
+    return CaptureFeatures(mean=mean,
+                           rms=rms,
+                           peak=peak,
+                           crest_factor=crest_factor,
+                           kurtosis=kurtosis,
+                           band_energy=band_energy)
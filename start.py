@@ -1,28 +1,23 @@
 import logging
-import time
 import argparse
-import tkinter as tk
-from tkinter import ttk
 
-from lib.logging_config import logger
-from lib.SerialDevice import SerialDevice
-from lib.AccController import AccController
-from lib.AccTestApp import AccTestApp
-from lib.DesktopApp import DesktopApp
+# Only what argument parsing needs is imported up front, the GUI and the
+# acquisition modules are imported by the mode that uses them
+from lib.logging_config import logger, setup_logging
 
 
 logger = logging.getLogger(__name__)
 
 
-if __name__ == '__main__':
+def main(argv=None):
     parser = argparse.ArgumentParser(
         description="MainApp for data acquisition")
 
     parser.add_argument('--desktop', action='store_true',
                         help='Flag to indicate desktop mode (default: False)')
 
-    parser.add_argument('--port', type=str, default='COM8',
-                        required=True, help='Port for SerialDevice (default: COM8)')
+    parser.add_argument('--port', type=str, nargs='+', default=['COM8'],
+                        required=True, help='Port(s) for SerialDevice, several ports run the devices in parallel (default: COM8)')
     parser.add_argument('--baudrate', type=int, default=230400,
                         required=True, help='Baudrate for SerialDevice (default: 230400)')
 
@@ -42,8 +37,33 @@ if __name__ == '__main__':
     parser.add_argument('--acqodrrun', action='store_true')
     parser.add_argument('--acqtimerrun', action='store_true')
     parser.add_argument('--looptimes', type=int, default=1)
-
-    args = parser.parse_args()
+    parser.add_argument('--batchwindow', type=int, default=1,
+                        help='Number of sample batch requests kept in flight while downloading (default: 1)')
+    parser.add_argument('--readerthread', action='store_true',
+                        help='Receive through a background reader thread instead of polling the port')
+    parser.add_argument('--continuous', action='store_true',
+                        help='Start the next acquisition while the previous capture is being saved')
+    parser.add_argument('--batchcommands', action='store_true',
+                        help='Send all changed accelerometer settings in one write')
+    parser.add_argument('--calibrate', action='store_true',
+                        help='Negotiate baud rate and batch size with the device, the result is cached per port and device')
+    parser.add_argument('--stream', action='store_true',
+                        help='Write every capture to its file batch by batch while downloading, in bounded memory (not with --continuous)')
+    parser.add_argument('--format', choices=['csv', 'bin'], default='csv',
+                        help='Capture file format (default: csv)')
+    parser.add_argument('--campaign', type=str, default='',
+                        help='Run the parameter sweep of this JSON/TOML plan in one session, the other parameters are its base')
+    parser.add_argument('--catalog', type=str, default='',
+                        help='Record every written capture in this SQLite capture catalog')
+    parser.add_argument('--metrics', type=str, default='',
+                        help='Write timing metrics to this file at the end of the run (*.prom: Prometheus text format, otherwise JSON)')
+    parser.add_argument('--loglevel', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='DEBUG',
+                        help='Log level (default: DEBUG)')
+    parser.add_argument('--wiretrace', type=int, default=0,
+                        help='Log a hex dump of every n-th serial packet, 0 disables it (default: 0)')
+
+    args = parser.parse_args(argv)
+    setup_logging(level=args.loglevel, wire_trace_every=args.wiretrace)
 
     if not args.desktop:
         required_args = ['port', 'baudrate', 'selectacc', 'accscale', 'acqnumsamples', 'acqdecfactor', 'acqtimsamplerate']
@@ -51,16 +71,40 @@ if __name__ == '__main__':
         if missing_args:
             parser.error(f"The following arguments are required in non-desktop mode: {', '.join(missing_args)}")
 
-        param_dict = vars(parser.parse_args())
+        param_dict = vars(args)
 
         logger.info('Running in embedded mode.')
-        app = AccTestApp(param_dict)
-        app.init()
-        app.run()
+        if args.campaign:
+            from lib.CampaignRunner import CampaignRunner
+            if len(param_dict['port']) > 1:
+                parser.error('A campaign runs on a single port.')
+            param_dict['port'] = param_dict['port'][0]
+            CampaignRunner(param_dict, CampaignRunner.load_plan(args.campaign)).run()
+        else:
+            if len(param_dict['port']) > 1:
+                from lib.MultiAccTestApp import MultiAccTestApp
+                app = MultiAccTestApp(param_dict)
+            else:
+                from lib.AccTestApp import AccTestApp
+                param_dict['port'] = param_dict['port'][0]
+                app = AccTestApp(param_dict)
+            app.init()
+            app.run()
+
+        if args.metrics:
+            from lib.metrics import registry
+            registry.dump(args.metrics)
 
     else:
+        import tkinter as tk
+        from lib.DesktopApp import DesktopApp
+
         root = tk.Tk()
         app = DesktopApp(root)
         root.mainloop()
 
 
+if __name__ == '__main__':
+    main()
+
+